@@ -2,14 +2,14 @@ __all__ = ['save_model', 'load_model']
 
 import os
 from .models import Lm, Lm2, Lmer
-from .utils import _df_meta_to_arr
-from rpy2.robjects.packages import importr
+from .utils import _df_meta_to_arr, _r_package
 import deepdish as dd
 import pandas as pd
 import warnings
 from tables import NaturalNameWarning
 
-base = importr("base")
+# Attributes that only cache intermediate state and are not saved with a model
+_TRANSIENT_ATTS = ['_design_infos', '_first_level_cache', '_r_data_cache']
 
 
 def save_model(model, filepath, compression='zlib', **kwargs):
@@ -31,6 +31,8 @@ def save_model(model, filepath, compression='zlib', **kwargs):
         simple_atts, data_atts = {}, {}
         for k, v in vars(model).items():
             skip = False
+            if k in _TRANSIENT_ATTS:
+                continue
             if k == 'model_obj':
                 skip = True
             elif isinstance(v, pd.DataFrame):
@@ -82,7 +84,7 @@ def save_model(model, filepath, compression='zlib', **kwargs):
 
         # Now deal with model object in R if needed
         if model.model_obj is not None:
-            base.saveRDS(model.model_obj, f"{filename}.rds")
+            _r_package("base").saveRDS(model.model_obj, f"{filename}.rds")
             assert os.path.exists(f"{filename}.rds")
     else:
         raise IOError("filepath must end with .h5 or .hdf5")
@@ -173,7 +175,7 @@ def load_model(filepath):
         # Now deal with model object in R if needed
         if isinstance(model, Lmer):
             filename = filepath.split('.')[0]
-            model.model_obj = base.readRDS(f"{filename}.rds")
+            model.model_obj = _r_package("base").readRDS(f"{filename}.rds")
         return model
     else:
         raise IOError("filepath must end with .h5 or .hdf5")
@@ -9,7 +9,8 @@ from copy import copy
 import warnings
 import numpy as np
 import pandas as pd
-from patsy import dmatrices
+from itertools import chain
+from patsy import dmatrices, dmatrix, incr_dbuilders, build_design_matrices
 from scipy.stats import t as t_dist
 from joblib import Parallel, delayed
 from ..stats import rsquared, rsquared_adj
@@ -17,9 +18,17 @@ from ..utils import (
     _sig_stars,
     _chunk_boot_ols_coefs,
     _chunk_perm_ols,
+    _chunk_seeds,
+    _cluster_codes,
+    _cluster_dof,
+    _corrs_from_cov,
     _ols,
+    _OLSSolver,
+    _robust_estimator,
     _perm_find,
-    _welch_ingredients
+    _process_pool,
+    _welch_ingredients,
+    _whiten_wls,
 )
 
 
@@ -74,6 +83,8 @@ class Lm(object):
         self.ranked_data = False
         self.estimator = None
         self.design_matrix = None
+        self._suff_stats = None
+        self._design_infos = None
 
     def __repr__(self):
         out = "{}(fitted={}, formula={}, family={})".format(
@@ -130,8 +141,8 @@ class Lm(object):
             verbose (bool): whether to print which model, standard error, confidence interval, and inference type are being fitted
             n_boot (int): how many bootstrap resamples to use for confidence intervals (ignored unless conf_int='boot')
             n_jobs (int): number of cores for parallelizing bootstrapping or permutations; default 1
-            n_lags (int): number of lags for robust estimator type 'hac' (ignored unless robust='hac'); default 1
-            cluster (str): column name identifying clusters/groups for robust estimator type 'cluster' (ignored unless robust='cluster')
+            n_lags (int/str): number of lags for robust estimator type 'hac' (ignored unless robust='hac'). Use 'auto' to select the number of lags from the number of observations via the Newey-West (1994) rule of thumb; default 1
+            cluster (str/list): column name identifying clusters/groups for robust estimator type 'cluster' (ignored unless robust='cluster'). Pass a list of two column names for two-way cluster-robust standard errors (Cameron, Gelbach & Miller 2011)
             weights (string/pd.Series/np.ndarray): weights to perform WLS instead of OLS. Pass in a column name in data to use to compute group variances and automatically adjust dof. Otherwise provide an array or series containing 1 / variance of each observation, in which case dof correction will not occur.
             wls_dof_correction (bool): whether to apply Welch-Satterthwaite approximate correction for dof when using weights based on an existing column in the data, ignored otherwise. Set to False to force standard dof calculation
 
@@ -153,6 +164,10 @@ class Lm(object):
             Same as above but with cluster-robust standard errors. The cluster argument should refer to a column in the dataframe.
 
             >>> model.fit(robust='cluster', cluster='Group')
+
+            Two-way cluster-robust standard errors, e.g. clustering on both subjects and items.
+
+            >>> model.fit(robust='cluster', cluster=['Subject', 'Item'])
             
             Simple regression with categorical predictor, i.e. between groups t-test assuming equal variances  
 
@@ -180,14 +195,19 @@ class Lm(object):
                 robust = "hc1"
             self.se_type = "robust" + " (" + robust + ")"
             if cluster:
-                if cluster not in self.data.columns:
+                if isinstance(cluster, str):
+                    cluster = [cluster]
+                if len(cluster) > 2:
+                    raise ValueError(
+                        "cluster must be a single column name or a list of two column names"
+                    )
+                if not all([c in self.data.columns for c in cluster]):
                     raise ValueError(
                         "cluster identifier must be an existing column in data"
                     )
-                else:
-                    cluster = self.data[cluster]
         else:
             self.se_type = "non-robust"
+            cluster = None
 
         if self.family == "gaussian":
             if verbose:
@@ -257,6 +277,8 @@ class Lm(object):
                 weight_vals = 1 / weight_groups[dv].transform(np.var, ddof=1)
         else:
             weight_vals = weights
+        if weight_vals is not None:
+            weight_vals = np.asarray(weight_vals)
         if weights is None:
             self.estimator = "OLS"
         else:
@@ -264,6 +286,18 @@ class Lm(object):
 
         y, x = dmatrices(self.formula, ddat, 1, return_type="dataframe")
         self.design_matrix = x
+        self._suff_stats = None
+        self._design_infos = [y.design_info, x.design_info]
+
+        if cluster:
+            # Integer cluster codes are computed once and reused by every robust computation, including permutations
+            cluster = _cluster_codes(self.data.loc[x.index, cluster])
+
+        # Factor the (whitened) design matrix once and share it with the robust and permutation computations
+        if weight_vals is not None:
+            solver = _OLSSolver(_whiten_wls(x.values, weight_vals))
+        else:
+            solver = _OLSSolver(x.values)
 
         # Compute standard estimates
         b, se, t, res = _ols(
@@ -274,12 +308,11 @@ class Lm(object):
             n_lags=n_lags,
             cluster=cluster,
             weights=weight_vals,
+            solver=solver,
         )
         if cluster is not None:
             # Cluster corrected dof (num clusters - num coef)
-            # Differs from stats and statsmodels which do num cluster - 1
-            # Ref: http://cameron.econ.ucdavis.edu/research/Cameron_Miller_JHR_2015_February.pdf
-            df = cluster.nunique() - x.shape[1]
+            df = _cluster_dof(cluster, x.shape[1])
         else:
             df = x.shape[0] - x.shape[1]
             if isinstance(weights, str) and wls_dof_correction:
@@ -305,20 +338,25 @@ class Lm(object):
         if conf_int == "boot":
 
             # Parallelize bootstrap computation for CIs
-            par_for = Parallel(n_jobs=n_jobs, backend="multiprocessing")
+            par_for = _process_pool(n_jobs)
 
             # To make sure that parallel processes don't use the same random-number generator pass in seed (sklearn trick)
             seeds = np.random.randint(np.iinfo(np.int32).max, size=n_boot)
 
             # Since we're bootstrapping coefficients themselves we don't need the robust info anymore
+            # The design matrix is reused, so each task only resamples row indices for a memory-bounded block of draws
+            # Plain arrays (rather than dataframes) are passed so large ones reach workers as read-only memory maps instead of copies
             boot_betas = par_for(
                 delayed(_chunk_boot_ols_coefs)(
-                    dat=self.data, formula=self.formula, weights=weights, seed=seeds[i]
+                    x=x.values,
+                    y=y.values.squeeze(),
+                    weights=weight_vals,
+                    seeds=seed_chunk,
                 )
-                for i in range(n_boot)
+                for seed_chunk in _chunk_seeds(seeds, x.shape[0] * x.shape[1], n_jobs)
             )
 
-            boot_betas = np.array(boot_betas)
+            boot_betas = np.vstack(boot_betas)
             ci_u = np.percentile(boot_betas, 97.5, axis=0)
             ci_l = np.percentile(boot_betas, 2.5, axis=0)
 
@@ -330,25 +368,23 @@ class Lm(object):
         if permute:
             # Permuting will change degrees of freedom to num_iter and p-values
             # Parallelize computation
-            # Unfortunate monkey patch that robust estimation hangs with multiple processes; maybe because of function nesting level??
-            # _chunk_perm_ols -> _ols -> _robust_estimator
-            if robust:
-                n_jobs = 1
-            par_for = Parallel(n_jobs=n_jobs, backend="multiprocessing")
+            # Each chunk is dominated by numpy/BLAS block operations that release the GIL, so threads scale without copying the design matrix into separate processes (which also used to hang with robust estimators)
+            par_for = Parallel(n_jobs=n_jobs, backend="threading")
             seeds = np.random.randint(np.iinfo(np.int32).max, size=permute)
+            # Each task handles a memory-bounded block of permutations against a single factorization of the design matrix
             perm_ts = par_for(
                 delayed(_chunk_perm_ols)(
-                    x=x,
-                    y=y,
+                    solver=solver,
+                    y=y.values.squeeze(),
                     robust=robust,
                     n_lags=n_lags,
                     cluster=cluster,
-                    weights=weights,
-                    seed=seeds[i],
+                    weights=weight_vals,
+                    seeds=seed_chunk,
                 )
-                for i in range(permute)
+                for seed_chunk in _chunk_seeds(seeds, x.shape[0], n_jobs)
             )
-            perm_ts = np.array(perm_ts)
+            perm_ts = np.vstack(perm_ts)
 
             p = []
             for col, fit_t in zip(range(perm_ts.shape[1]), t):
@@ -409,6 +445,257 @@ class Lm(object):
         if summarize:
             return self.summary()
 
+    def fit_stream(self, chunks, robust=False, summarize=True, verbose=False):
+        """
+        Fit an OLS model to data that are too large to hold in memory by streaming over chunks of rows. Each chunk only contributes to running sufficient statistics (X'X, X'y, y'y and the number of observations) from which coefficients, standard errors, R^2, log-likelihood, AIC and BIC are computed, so memory use does not depend on the total number of rows. The model's data attribute is not used and residuals and fits are not stored. Bootstrapping, permutation, WLS and rank models are not supported.
+
+        Args:
+            chunks (iterable/callable): an iterable of dataframes, e.g. `pd.read_csv(..., chunksize=...)`, or a function that returns a new such iterable each time it's called. A function is required for robust standard errors which need a second pass over the data. It is also recommended if the data contain categorical predictors, so that all factor levels can be discovered in an initial pass; otherwise factor levels are taken from the first chunk
+            robust (bool/str): whether to use heteroscedasticity robust s.e. and optionally which estimator type to use ('hc0','hc1', 'hc2', hc3'). If robust = True, default robust estimator is 'hc1'; default False
+            summarize (bool): whether to print a model summary after fitting; default True
+            verbose (bool): whether to print when passes over the data are being made
+
+        Returns:
+            pd.DataFrame: R/statsmodels style summary
+
+        Examples:
+
+            >>> model = Lm('DV ~ IV1 + IV2', data=None)
+            >>> model.fit_stream(lambda: pd.read_csv('big_file.csv', chunksize=100000))
+
+        """
+
+        if robust:
+            if isinstance(robust, bool):
+                robust = "hc1"
+            if robust not in ["hc0", "hc1", "hc2", "hc3"]:
+                raise ValueError(
+                    "Streaming fits only support robust estimators 'hc0', 'hc1', 'hc2' or 'hc3'"
+                )
+            if not callable(chunks):
+                raise TypeError(
+                    "chunks must be a function that returns a new iterable of dataframes to compute robust standard errors"
+                )
+
+        # Figure out the design (e.g. factor levels) once, so every chunk produces the same columns
+        if callable(chunks):
+            if verbose:
+                print("Determining model design from data...\n")
+            self._design_infos = incr_dbuilders(self.formula, chunks, 1)
+            chunk_iter = chunks()
+        else:
+            chunk_iter = iter(chunks)
+            first_chunk = next(chunk_iter)
+            y, x = dmatrices(self.formula, first_chunk, 1, return_type="dataframe")
+            self._design_infos = [y.design_info, x.design_info]
+            chunk_iter = chain([first_chunk], chunk_iter)
+
+        if verbose:
+            print("Accumulating sufficient statistics...\n")
+        self._suff_stats = None
+        for chunk in chunk_iter:
+            self._update_suff_stats(chunk)
+
+        if robust and verbose:
+            print("Computing robust standard errors in a second pass...\n")
+        self._fit_from_suff_stats(robust=robust, chunks=chunks)
+
+        if summarize:
+            return self.summary()
+
+    def partial_fit(self, data, summarize=False):
+        """
+        Update a fitted OLS model with a batch of new observations without refitting on the full history. The model keeps running sufficient statistics (X'X, X'y, y'y and the number of observations), so coefficients, standard errors, R^2, log-likelihood, AIC and BIC are refreshed in time proportional to the size of the batch. If the model was fit with `.fit()` the sufficient statistics are built from its design matrix the first time this is called. Calling this on an unfitted model starts a new fit from data. Standard errors are always non-robust. Residuals and fits can't be updated, so they are set to None and the 'fits' and 'residuals' columns are removed from the model's data; `.to_corrs()` is also unavailable until the model is refit with `.fit()`. Use `.remove_rows()` to drop observations again, e.g. for sliding windows.
+
+        Args:
+            data (pd.DataFrame): new observations containing all columns in the model formula
+            summarize (bool): whether to print a model summary after updating; default False
+
+        Returns:
+            pd.DataFrame: R/statsmodels style summary
+
+        """
+
+        if self._suff_stats is None:
+            if self.fitted:
+                self._init_suff_stats()
+            else:
+                y, x = dmatrices(self.formula, data, 1, return_type="dataframe")
+                self._design_infos = [y.design_info, x.design_info]
+        elif self._design_infos is None:
+            self._restore_design_infos()
+        self._update_suff_stats(data)
+        self._fit_from_suff_stats()
+
+        if summarize:
+            return self.summary()
+
+    def remove_rows(self, data, summarize=False):
+        """
+        Downdate a fitted OLS model by removing a batch of observations that it was previously fit or updated with, without refitting on the remaining history. Together with `.partial_fit()` this supports sliding window estimation. As with `.partial_fit()`, standard errors are always non-robust and residuals and fits are removed rather than updated.
+
+        Args:
+            data (pd.DataFrame): observations to remove containing all columns in the model formula
+            summarize (bool): whether to print a model summary after updating; default False
+
+        Returns:
+            pd.DataFrame: R/statsmodels style summary
+
+        """
+
+        if not self.fitted:
+            raise RuntimeError("Model must be fitted to remove observations!")
+        if self._suff_stats is None:
+            self._init_suff_stats()
+        elif self._design_infos is None:
+            self._restore_design_infos()
+        y, x = build_design_matrices(self._design_infos, data)
+        if self._suff_stats["n"] - x.shape[0] <= x.shape[1]:
+            raise ValueError(
+                "Removing these observations would leave fewer observations than model parameters"
+            )
+        self._update_suff_stats((y, x), sign=-1)
+        self._fit_from_suff_stats()
+
+        if summarize:
+            return self.summary()
+
+    def _init_suff_stats(self):
+        """
+        Build sufficient statistics and the design used for new observations from the data of a model fitted with `.fit()`, e.g. after it was loaded from disk.
+        """
+
+        if self.estimator != "OLS" or self.ranked_data:
+            raise ValueError(
+                "Only models fit with OLS on unranked data can be updated incrementally"
+            )
+        if not isinstance(self.data, pd.DataFrame):
+            raise ValueError("Model data are required to update a fitted model")
+        y, x = dmatrices(self.formula, self.data, 1, return_type="dataframe")
+        self._design_infos = [y.design_info, x.design_info]
+        X, Y = x.values, y.values[:, 0]
+        self._suff_stats = {
+            "XtX": np.dot(X.T, X),
+            "Xty": np.dot(X.T, Y),
+            "yty": np.dot(Y, Y),
+            "y_sum": Y.sum(),
+            "n": X.shape[0],
+        }
+
+    def _restore_design_infos(self):
+        """
+        Rebuild the design used for new observations of an incrementally updated model, e.g. after it was loaded from disk, from the data it was originally fit on. Models without data (e.g. fit with `.fit_stream()`) need to be refit.
+        """
+
+        if isinstance(self.data, pd.DataFrame) and self.data.shape[0]:
+            y, x = dmatrices(self.formula, self.data, 1, return_type="dataframe")
+            if list(x.columns) == list(self.coefs.index):
+                self._design_infos = [y.design_info, x.design_info]
+                return
+        raise ValueError(
+            "The design of this incrementally updated model can't be recovered from its data; refit the model before updating it"
+        )
+
+    def _update_suff_stats(self, data, sign=1):
+        """
+        Add (sign=1) or remove (sign=-1) the rows in data from the model's sufficient statistics. Data can also be a (y, x) tuple of design matrices already built from it.
+        """
+
+        if isinstance(data, tuple):
+            y, x = data
+        else:
+            y, x = build_design_matrices(self._design_infos, data)
+        X, Y = np.asarray(x), np.asarray(y)[:, 0]
+        if self._suff_stats is None:
+            self._suff_stats = {
+                "XtX": np.zeros((X.shape[1], X.shape[1])),
+                "Xty": np.zeros(X.shape[1]),
+                "yty": 0.0,
+                "y_sum": 0.0,
+                "n": 0,
+            }
+        self._suff_stats["XtX"] += sign * np.dot(X.T, X)
+        self._suff_stats["Xty"] += sign * np.dot(X.T, Y)
+        self._suff_stats["yty"] += sign * np.dot(Y, Y)
+        self._suff_stats["y_sum"] += sign * Y.sum()
+        self._suff_stats["n"] += sign * X.shape[0]
+
+    def _fit_from_suff_stats(self, robust=False, chunks=None):
+        """
+        Compute coefficients, inference and fit statistics from the model's sufficient statistics. Robust standard errors require a callable chunks to make a second pass over the data to compute residuals.
+        """
+
+        stats = self._suff_stats
+        column_names = self._design_infos[1].column_names
+        n, num_coefs = stats["n"], len(column_names)
+        bread = np.linalg.pinv(stats["XtX"])
+        b = np.dot(bread, stats["Xty"])
+        ssr = stats["yty"] - 2 * np.dot(b, stats["Xty"]) + np.dot(b, np.dot(stats["XtX"], b))
+        df = n - num_coefs
+
+        if robust:
+            meat = np.zeros_like(bread)
+            for chunk in chunks():
+                y, x = build_design_matrices(self._design_infos, chunk)
+                X, Y = np.asarray(x), np.asarray(y)[:, 0]
+                V = (Y - np.dot(X, b)) ** 2
+                if robust in ["hc2", "hc3"]:
+                    leverage = np.sum(np.dot(X, bread) * X, axis=1)
+                    V = V / (1 - leverage) ** (1 if robust == "hc2" else 2)
+                meat += np.dot(X.T * V, X)
+            if robust == "hc1":
+                meat = meat * n / df
+            se = np.sqrt(np.diag(np.dot(np.dot(bread, meat), bread)))
+            self.se_type = "robust" + " (" + robust + ")"
+        else:
+            se = np.sqrt(np.diag(bread) * ssr / df)
+            self.se_type = "non-robust"
+
+        t = b / se
+        p = 2 * (1 - t_dist.cdf(np.abs(t), df))
+        results = pd.DataFrame(
+            {
+                "Estimate": b,
+                "2.5_ci": b + t_dist.ppf(0.025, df) * se,
+                "97.5_ci": b + t_dist.ppf(0.975, df) * se,
+                "SE": se,
+                "DF": df,
+                "T-stat": t,
+                "P-val": p,
+                "Sig": [_sig_stars(elem) for elem in p],
+            },
+            index=column_names,
+        )
+
+        self.coefs = results
+        self.fitted = True
+        self.estimator = "OLS"
+        self.ci_type = "standard"
+        self.sig_type = "parametric"
+        self.ranked_data = False
+        self.design_matrix = pd.DataFrame(columns=column_names)
+        self.residuals = None
+        self.fits = None
+        stale = ["fits", "residuals"]
+        if isinstance(self.data, pd.DataFrame) and self.data.columns.isin(stale).any():
+            # Don't leave fits from a previous call behind; only the first update pays for copying the data
+            self.data = self.data.drop(columns=stale, errors="ignore")
+
+        # Fit statistics
+        center_tss = "Intercept" in column_names
+        if center_tss:
+            tss = stats["yty"] - stats["y_sum"] ** 2 / n
+        else:
+            tss = stats["yty"]
+        self.rsquared = 1 - ssr / tss
+        self.rsquared_adj = rsquared_adj(self.rsquared, n, df, center_tss)
+        half_obs = n / 2.0
+        self.logLike = (-np.log(ssr) * half_obs) - (
+            (1 + np.log(np.pi / half_obs)) * half_obs
+        )
+        self.AIC = 2 * num_coefs - 2 * self.logLike
+        self.BIC = np.log(n) * num_coefs - 2 * self.logLike
+
     def summary(self):
         """
         Summarize the output of a fitted model.
@@ -428,9 +715,13 @@ class Lm(object):
                 self.se_type, self.ci_type, self.sig_type
             )
         )
+        if self._suff_stats is not None:
+            n_obs = self._suff_stats["n"]
+        else:
+            n_obs = self.data.shape[0]
         print(
             "Number of observations: %s\t R^2: %.3f\t R^2_adj: %.3f\n"
-            % (self.data.shape[0], self.rsquared, self.rsquared_adj)
+            % (n_obs, self.rsquared, self.rsquared_adj)
         )
         print(
             "Log-likelihood: %.3f \t AIC: %.3f\t BIC: %.3f\n"
@@ -458,42 +749,15 @@ class Lm(object):
             )
         if corr_type not in ["semi", "partial"]:
             raise ValueError("corr_type must be 'semi' or 'partial'")
-        from scipy.stats import pearsonr
-
-        corrs = []
-        corrs.append(np.nan)  # don't compute for intercept
-        for c in self.design_matrix.columns[1:]:
-            dv = self.formula.split("~")[0]
-            other_preds = [e for e in self.design_matrix.columns[1:] if e != c]
-            right_side = "+".join(other_preds)
-            y, x = dmatrices(
-                c + "~" + right_side, self.data, 1, return_type="dataframe"
-            )
-            pred_m_resid = _ols(
-                x,
-                y,
-                robust=False,
-                n_lags=1,
-                cluster=None,
-                all_stats=False,
-                resid_only=True,
-            )
-            y, x = dmatrices(
-                dv + "~" + right_side, self.data, 1, return_type="dataframe"
+        if self._suff_stats is not None:
+            raise RuntimeError(
+                "Partial correlations can't be computed for a model fit from sufficient statistics (fit_stream, partial_fit or remove_rows); refit the model with .fit()"
             )
-            if corr_type == "semi":
-                dv_m_resid = y.values.squeeze()
-            elif corr_type == "partial":
-                dv_m_resid = _ols(
-                    x,
-                    y,
-                    robust=False,
-                    n_lags=1,
-                    cluster=None,
-                    all_stats=False,
-                    resid_only=True,
-                )
-            corrs.append(pearsonr(dv_m_resid, pred_m_resid)[0])
+        # All correlations come from the covariance of the design (excluding the intercept) and dv
+        y, x = dmatrices(self.formula, self.data, 1, return_type="dataframe")
+        cov = np.cov(np.column_stack([x.values[:, 1:], y.values[:, 0]]), rowvar=False)
+        # don't compute for intercept
+        corrs = np.concatenate([[np.nan], _corrs_from_cov(cov, corr_type)])
         if ztrans_corrs:
             corrs = np.arctanh(corrs)
         return pd.Series(corrs, index=self.coefs.index)
@@ -520,3 +784,144 @@ class Lm(object):
         else:
             preds = np.dot(X, coefs[1:])
         return preds
+
+    @classmethod
+    def mass_univariate(
+        cls,
+        formula,
+        data,
+        dvs,
+        robust=False,
+        permute=False,
+        rank=False,
+        n_jobs=1,
+        n_lags=1,
+        cluster=None,
+    ):
+        """
+        Fit the same model to many dependent variables at once, i.e. mass-univariate OLS. The design matrix is built and factored a single time and estimates for all dependent variables are computed together as block matrix operations, which is much faster than fitting a separate Lm for each dependent variable. Standard errors, robust estimators and permutation tests work the same way as in `.fit()`.
+
+        Args:
+            formula (str): right-hand side of a model formula, e.g. 'IV1 + IV2' or '~ IV1 + IV2'; a left-hand side, if provided, is ignored
+            data (pd.DataFrame): input data containing the predictors
+            dvs (list/np.ndarray/pd.DataFrame): list of column names in data to use as dependent variables, or a 2d array/dataframe with one column per dependent variable and the same number of rows as data
+            robust (bool/str): whether to use heteroscedasticity robust s.e. and optionally which estimator type to use ('hc0','hc1', 'hc2', hc3','hac','cluster'). If robust = True, default robust estimator is 'hc1'; default False
+            permute (int): if non-zero, computes parameter significance tests by permuting t-stastics rather than parametrically. Rows are shuffled identically for all dependent variables
+            rank (bool): convert all predictors and dependent variables to ranks before estimating models; default False
+            n_jobs (int): number of cores for parallelizing permutations; default 1
+            n_lags (int/str): number of lags for robust estimator type 'hac' (ignored unless robust='hac'); default 1
+            cluster (str/list): column name(s) identifying clusters/groups for robust estimator type 'cluster' (ignored unless robust='cluster')
+
+        Returns:
+            dict: 'Estimate', 'SE', 'T-stat' and 'P-val' (plus 'Perm-P-val' if permute) dataframes with one row per dependent variable and one column per model term, along with 'rsquared' and 'rsquared_adj' series with one value per dependent variable
+
+        Examples:
+
+            >>> results = Lm.mass_univariate('IV1 + IV2', data=df, dvs=['DV1', 'DV2', 'DV3'])
+            >>> results['T-stat']
+
+        """
+
+        if permute is True:
+            raise TypeError("permute should 'False' or the number of permutations to perform")
+        elif permute and permute < 500:
+            warnings.warn("Permutation testing < 500 permutations is not recommended")
+        if robust:
+            if isinstance(robust, bool):
+                robust = "hc1"
+        else:
+            cluster = None
+
+        if isinstance(dvs, (list, tuple, pd.Index)):
+            if not all([dv in data.columns for dv in dvs]):
+                raise ValueError("dvs must be existing columns in data")
+            Y = data[list(dvs)]
+        else:
+            if dvs.shape[0] != data.shape[0]:
+                raise ValueError("dvs must have the same number of rows as data")
+            Y = pd.DataFrame(np.asarray(dvs), index=data.index)
+            if isinstance(dvs, pd.DataFrame):
+                Y.columns = dvs.columns
+        if Y.ndim == 1 or Y.shape[1] == 0:
+            raise ValueError("dvs must contain at least one dependent variable")
+
+        if rank:
+            data = data.rank()
+            Y = Y.rank()
+
+        rhs = formula.replace(" ", "").split("~")[-1]
+        x = dmatrix(rhs, data, 1, return_type="dataframe")
+        Y = Y.loc[x.index]
+        if Y.isnull().values.any():
+            raise ValueError("dvs cannot contain missing values")
+        Y_vals = Y.values.astype(float)
+
+        if cluster:
+            if isinstance(cluster, str):
+                cluster = [cluster]
+            cluster = _cluster_codes(data.loc[x.index, cluster])
+
+        # Factor the design matrix once for every dependent variable
+        solver = _OLSSolver(x.values)
+        b = solver.coef(Y_vals)
+        res = solver.resid(Y_vals, b)
+        if robust:
+            se = _robust_estimator(
+                res,
+                solver.X,
+                robust_estimator=robust,
+                n_lags=n_lags,
+                cluster=cluster,
+                solver=solver,
+            )
+        else:
+            se = solver.se(res)
+        t = b / se
+
+        if cluster is not None:
+            df = _cluster_dof(cluster, x.shape[1])
+        else:
+            df = x.shape[0] - x.shape[1]
+        p = 2 * (1 - t_dist.cdf(np.abs(t), df))
+
+        results = {}
+        for name, vals in zip(["Estimate", "SE", "T-stat", "P-val"], [b, se, t, p]):
+            results[name] = pd.DataFrame(vals.T, index=Y.columns, columns=x.columns)
+
+        if permute:
+            # Shuffle rows of all dependent variables together, in memory-bounded chunks of permutations
+            par_for = Parallel(n_jobs=n_jobs, backend="threading")
+            seeds = np.random.randint(np.iinfo(np.int32).max, size=permute)
+            perm_ts = par_for(
+                delayed(_chunk_perm_ols)(
+                    solver=solver,
+                    y=Y_vals,
+                    robust=robust,
+                    n_lags=n_lags,
+                    cluster=cluster,
+                    weights=None,
+                    seeds=seed_chunk,
+                )
+                for seed_chunk in _chunk_seeds(seeds, Y_vals.size, n_jobs)
+            )
+            perm_ts = np.concatenate(perm_ts, axis=0)
+            perm_p = (np.sum(np.abs(perm_ts) >= np.abs(t), axis=0) + 1) / (
+                float(permute) + 1
+            )
+            results["Perm-P-val"] = pd.DataFrame(
+                perm_p.T, index=Y.columns, columns=x.columns
+            )
+
+        # Fit statistics
+        center_tss = "Intercept" in x.columns
+        if center_tss:
+            tss = np.sum((Y_vals - Y_vals.mean(axis=0)) ** 2, axis=0)
+        else:
+            tss = np.sum(Y_vals ** 2, axis=0)
+        r2 = 1 - np.sum(res ** 2, axis=0) / tss
+        results["rsquared"] = pd.Series(r2, index=Y.columns)
+        results["rsquared_adj"] = pd.Series(
+            rsquared_adj(r2, x.shape[0], x.shape[0] - x.shape[1], center_tss),
+            index=Y.columns,
+        )
+        return results
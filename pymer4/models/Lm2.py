@@ -6,19 +6,24 @@ Main class for two-stage regression models
 """
 
 from copy import copy
+from itertools import chain
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
-from patsy import dmatrices
-from joblib import Parallel, delayed
-from .Lm import Lm
+from patsy import dmatrices, build_design_matrices
 from ..utils import (
+    MAX_CHUNK_BYTES,
     _sig_stars,
     _permute_sign,
-    _ols_group,
-    _corr_group,
-    _perm_find
+    _ols_groups,
+    _ols_one_sample,
+    _cluster_codes,
+    _corr_groups,
+    _perm_find,
+    _data_fingerprint,
+    _formula_cols,
+    _iter_frames,
 )
 
 
@@ -44,8 +49,10 @@ class Lm2(object):
         warnings (list): warnings output from Python
         fixef (pd.DataFrame): cluster-level parameters
         coefs (pd.DataFrame): model summary table of population parameters
-        residuals (numpy.ndarray): model residuals
-        fits (numpy.ndarray): model fits/predictions
+        residuals (numpy.ndarray): model residuals using each group's first-level estimates
+        fits (numpy.ndarray): model fits/predictions using each group's first-level estimates
+        population_residuals (numpy.ndarray): model residuals using only the second-level (population) estimates
+        population_fits (numpy.ndarray): model fits/predictions using only the second-level (population) estimates
         se_type (string): how standard errors are computed
         sig_type (string): how inference is performed
         
@@ -71,6 +78,9 @@ class Lm2(object):
         self.logLike = None
         self.warnings = []
         self.residuals = None
+        self.fits = None
+        self.population_residuals = None
+        self.population_fits = None
         self.fixef = None
         self.coefs = None
         self.model_obj = None
@@ -79,6 +89,10 @@ class Lm2(object):
         self.sig_type = None
         self.ranked_data = False
         self.iscorrs = False
+        self._first_level_cache = None
+        self._first_level_estimates = None
+        self._first_level_weights = None
+        self._first_level_opts = None
 
     def __repr__(self):
         out = "{}(fitted={}, formula={}, family={}, group={})".format(
@@ -90,6 +104,147 @@ class Lm2(object):
         )
         return out
 
+    @classmethod
+    def from_first_level(cls, fixef, ses=None, formula=None, family="gaussian"):
+        """
+        Create a model from first-level estimates computed elsewhere, e.g. per-subject coefficients from a mass-univariate pipeline, skipping the raw data and first-level regressions entirely. Calling `.fit()` on the returned model runs the usual second-level inference (robust standard errors, bootstrapped confidence intervals, permutation tests) on these estimates. First-level options that require raw data (rank and to_corrs) can't be used. If standard errors of the first-level estimates are provided, second-level estimates are precision weighted, i.e. each coefficient is estimated with WLS using 1 / se^2 as weights.
+
+        Args:
+            fixef (pd.DataFrame): groups x coefficients table of first-level estimates; the index identifies groups (its name is used as the group name) and columns identify coefficients
+            ses (pd.DataFrame): groups x coefficients table of standard errors of the first-level estimates with the same index and columns as fixef; optional
+            formula (str): model formula to report in summaries; defaults to the coefficient names
+            family (string): what distribution family (i.e.) link function to use for the generalized model; default is gaussian (linear model)
+
+        Returns:
+            Lm2: unfitted model
+
+        Examples:
+
+            >>> model = Lm2.from_first_level(betas, ses=std_errs)
+            >>> model.fit(permute=5000)
+
+        """
+
+        if not isinstance(fixef, pd.DataFrame):
+            raise TypeError("fixef must be a pandas DataFrame")
+        if formula is None:
+            formula = "~" + "+".join([str(c) for c in fixef.columns])
+        group = fixef.index.name if fixef.index.name is not None else "Group"
+        model = cls(formula, data=None, group=str(group), family=family)
+        model.fixef = fixef.copy()
+        model.fixef.index.name = model.group
+        model._first_level_estimates = model.fixef.astype(float)
+        if ses is not None:
+            ses = ses.reindex(index=fixef.index, columns=fixef.columns)
+            if ses.isnull().values.any() or (ses.values <= 0).any():
+                raise ValueError(
+                    "ses must contain a positive standard error for every group and coefficient in fixef"
+                )
+            model._first_level_weights = 1 / ses.values.astype(float) ** 2
+        return model
+
+    @classmethod
+    def from_stream(
+        cls,
+        formula,
+        source,
+        group,
+        rank=False,
+        to_corrs=False,
+        ztrans_corrs=True,
+        n_prefetch=0,
+        family="gaussian",
+    ):
+        """
+        Create a model by fitting the first-level regressions on data that arrive a few groups at a time, e.g. a directory with one .csv or .parquet file per subject, so the full long-format dataset never needs to be in memory. Frames are collected into batches of bounded size and every group in a batch is fit at once; only the first-level estimates are kept. All rows of a group must arrive in the same frame. The design (including factor levels) is taken from the first batch, so categorical predictors should have all their levels present there or be specified explicitly, e.g. C(x, levels=[...]). Calling `.fit()` on the returned model runs the second-level inference as usual; first-level options (rank, to_corrs, ztrans_corrs) are set here instead and the model has no fits or residuals.
+
+        Args:
+            formula (str): model formula
+            source (iterable/callable/str): an iterable of DataFrames each holding one or more whole groups, a callable returning one, or the path to a directory of .csv/.parquet files (searched recursively)
+            group (str): column name in each frame that identifies groups
+            rank (bool): convert predictors in model formula to ranks by group prior to estimation; default False
+            to_corrs (bool/string): for each first level model estimate a semi-partial or partial correlations instead of betas; default False
+            ztrans_corrs (bool): whether to fisher-z transform (arcsin) first-level correlations; default True
+            n_prefetch (int): number of frames to load ahead in background threads while groups are being fit; default 0
+            family (string): what distribution family (i.e.) link function to use for the generalized model; default is gaussian (linear model)
+
+        Returns:
+            Lm2: unfitted model
+
+        Examples:
+
+            >>> model = Lm2.from_stream("DV ~ IV1 + IV2", "data/subjects/", group="Subject", n_prefetch=4)
+            >>> model.fit(robust="hc3", permute=5000)
+
+        """
+
+        if isinstance(to_corrs, str):
+            if to_corrs not in ["semi", "partial"]:
+                raise ValueError("to_corrs must be 'semi' or 'partial'")
+        model = cls(formula, data=None, group=group, family=family)
+
+        design_infos, columns = None, None
+        betas, groups = [], []
+        batch, batch_bytes = [], 0
+        # A trailing None flushes the last partial batch
+        for frame in chain(_iter_frames(source, n_prefetch=n_prefetch), [None]):
+            if frame is not None:
+                if not isinstance(frame, pd.DataFrame):
+                    raise TypeError("source must yield pandas DataFrames")
+                batch.append(frame)
+                batch_bytes += frame.memory_usage(index=True, deep=True).sum()
+                if batch_bytes < MAX_CHUNK_BYTES:
+                    continue
+            if not batch:
+                continue
+            data = pd.concat(batch, ignore_index=True)
+            batch, batch_bytes = [], 0
+
+            if rank:
+                ddat = data.groupby(group, sort=False).rank()
+                ddat[group] = data[group]
+            else:
+                ddat = data
+            if design_infos is None:
+                y, x = dmatrices(model.formula, ddat, 1, return_type="dataframe")
+                design_infos = [y.design_info, x.design_info]
+                columns = x.columns
+            else:
+                y, x = build_design_matrices(design_infos, ddat, return_type="dataframe")
+            codes, uniques = pd.factorize(data.loc[x.index, group])
+            if len(groups) and pd.Index(groups).isin(uniques).any():
+                raise ValueError(
+                    "All rows of a group must arrive in the same frame, but some groups were split across frames"
+                )
+            groups.extend(uniques)
+
+            if to_corrs:
+                batch_betas = _corr_groups(x.values, y.values[:, 0], codes, to_corrs)
+                if ztrans_corrs:
+                    batch_betas = np.arctanh(batch_betas)
+            else:
+                batch_betas = _ols_groups(x.values, y.values[:, 0], codes)
+            betas.append(batch_betas)
+
+        if not betas:
+            raise ValueError("source didn't yield any data")
+        betas = np.vstack(betas)
+        groups = pd.Index(groups, name=model.group)
+        if to_corrs:
+            # Correlations aren't computed for the intercept, but its column keeps the design's column names with the estimates
+            estimates = np.column_stack([np.full(betas.shape[0], np.nan), betas])
+        else:
+            estimates = betas
+        model._first_level_estimates = pd.DataFrame(estimates, index=groups, columns=columns)
+        model._first_level_opts = {"rank": rank, "to_corrs": to_corrs}
+        if to_corrs:
+            ivs = [e.strip() for e in model.formula.split("~")[-1].split("+")]
+            model.fixef = pd.DataFrame(betas, columns=ivs)
+        else:
+            model.fixef = pd.DataFrame(betas, columns=columns)
+        model.fixef.index = groups
+        return model
+
     def fit(
         self,
         robust=False,
@@ -105,6 +260,7 @@ class Lm2(object):
         to_corrs=False,
         ztrans_corrs=True,
         cluster=None,
+        fits_to_data=True,
     ):
         """
         Fit a variety of second-level OLS models; all 1st-level models are standard OLS. By default will fit a model that makes parametric assumptions (under a t-distribution) replicating the output of software like R. 95% confidence intervals (CIs) are also estimated parametrically by default. However, empirical bootstrapping can also be used to compute CIs, which will resample with replacement from the first level regression estimates and uses these CIs to perform inference unless permutation tests are requested. Permutation testing  will perform a one-sample sign-flipped permutation test on the estimates directly (perm_on='coef') or the t-statistic (perm_on='t-stat'). Permutation is a bit different than Lm which always permutes based on the t-stat.
@@ -114,7 +270,7 @@ class Lm2(object):
         Args:
             robust (bool/str): whether to use heteroscedasticity robust s.e. and optionally which estimator type to use ('hc0','hc3','hac','cluster'). If robust = True, default robust estimator is 'hc0'; default False
             conf_int (str): whether confidence intervals should be computed through bootstrap ('boot') or assuming a t-distribution ('standard'); default 'standard'
-            permute (int): if non-zero, computes parameter significance tests by permuting t-stastics rather than parametrically; works with robust estimators
+            permute (int): if non-zero, computes parameter significance tests by permuting t-stastics rather than parametrically; works with robust estimators. If there are no more than permute possible sign flips of the first-level estimates (2 ** number of groups), all of them are used for an exact test; this is decided from the total number of groups, so coefficients with non-finite estimates for some groups are sampled rather than enumerated if only their finite groups would allow it
             perm_on (str): permute based on a null distribution of the 'coef' of first-level estimates or the 't-stat' of first-level estimates; default 't-stat'
             rank (bool): convert all predictors and dependent variable to ranks before estimating model; default False
             to_corrs (bool/string): for each first level model estimate a semi-partial or partial correlations instead of betas and perform inference over these partial correlation coefficients. *note* this is different than Lm(); default False
@@ -122,9 +278,10 @@ class Lm2(object):
             summarize (bool): whether to print a model summary after fitting; default True
             verbose (bool): whether to print which model, standard error, confidence interval, and inference type are being fitted
             n_boot (int): how many bootstrap resamples to use for confidence intervals (ignored unless conf_int='boot')
-            n_jobs (int): number of cores for parallelizing bootstrapping or permutations; default 1
-            n_lags (int): number of lags for robust estimator type 'hac' (ignored unless robust='hac'); default 1
-            cluster (str): column name identifying clusters/groups for robust estimator type 'cluster' (ignored unless robust='cluster')
+            n_jobs (int): not used; first-level estimates, bootstrapping and permutations are computed for all groups and coefficients at once. Kept for backwards compatibility
+            n_lags (int/str): number of lags for robust estimator type 'hac' (ignored unless robust='hac'). Use 'auto' to select the number of lags from the number of observations via the Newey-West (1994) rule of thumb; default 1
+            cluster (str): column name identifying clusters of groups (e.g. the site each subject belongs to) for robust estimator type 'cluster' (ignored unless robust='cluster'). Each group is assigned to the cluster of its first row
+            fits_to_data (bool): whether to also add first-level 'fits' and 'residuals' columns to the model's data; set to False to only keep them as arrays (along with population_fits and population_residuals) which saves memory with large datasets; default True
 
         Returns:
             DataFrame: R style summary() table
@@ -136,12 +293,10 @@ class Lm2(object):
                 robust = "hc0"
             self.se_type = "robust" + " (" + robust + ")"
             if cluster:
-                if cluster not in self.data.columns:
+                if self.data is None or cluster not in self.data.columns:
                     raise ValueError(
                         "cluster identifier must be an existing column in data"
                     )
-                else:
-                    cluster = self.data[cluster]
         else:
             self.se_type = "non-robust"
         self.ci_type = (
@@ -163,84 +318,71 @@ class Lm2(object):
             else:
                 self.sig_type = "parametric"
 
-        # Parallelize regression computation for 1st-level models
-        par_for = Parallel(n_jobs=n_jobs, backend="multiprocessing")
-
+        if self.data is None:
+            if rank or to_corrs:
+                raise ValueError(
+                    "rank and to_corrs require raw data and can't be used with a model created from first-level estimates"
+                )
+            if self._first_level_opts is not None:
+                # First-level options were applied when the model was created from a stream
+                rank = self._first_level_opts["rank"]
+                to_corrs = self._first_level_opts["to_corrs"]
         if rank:
             self.ranked_data = True
         else:
             self.ranked_data = False
 
-        if to_corrs:
-            # Loop over each group and get semi/partial correlation estimates
-            # Reminder len(betas) == len(betas) - 1, from normal OLS, since corr of intercept is not computed
-            betas = par_for(
-                delayed(_corr_group)(
-                    self.data,
-                    self.formula,
-                    self.group,
-                    self.data[self.group].unique()[i],
-                    self.ranked_data,
-                    to_corrs,
-                )
-                for i in range(self.data[self.group].nunique())
-            )
-            if ztrans_corrs:
-                betas = np.arctanh(betas)
-            else:
-                betas = np.array(betas)
-        else:
-            # Loop over each group and fit a separate regression
-            betas = par_for(
-                delayed(_ols_group)(
-                    self.data,
-                    self.formula,
-                    self.group,
-                    self.data[self.group].unique()[i],
-                    self.ranked_data,
-                )
-                for i in range(self.data[self.group].nunique())
+        betas, columns, design, groups, rows = self._fit_first_level(
+            to_corrs, ztrans_corrs
+        )
+        if robust and cluster:
+            # Second-level observations are groups, so each group belongs to the cluster of its first row used in the first-level fit
+            cluster = _cluster_codes(
+                pd.Series(self.data[cluster].values[rows])
+                .groupby(self.data[self.group].values[rows], sort=False)
+                .first()
+                .reindex(groups)
             )
-            betas = np.array(betas)
 
-        # Get the model matrix formula from patsy to make it more reliable to set the results dataframe index like Lmer
-        y, x = dmatrices(self.formula, self.data, 1, return_type="dataframe")
-        # Perform an intercept only regression for each beta
-        results = []
+        # Perform an intercept only regression for all betas at once
+        results = _ols_one_sample(
+            betas,
+            robust=robust,
+            n_lags=n_lags,
+            cluster=cluster,
+            conf_int=conf_int,
+            n_boot=n_boot,
+            weights=self._first_level_weights,
+        )
         perm_ps = []
-        for i in range(betas.shape[1]):
-            df = pd.DataFrame({"X": np.ones_like(betas[:, i]), "Y": betas[:, i]})
-            lm = Lm("Y ~ 1", data=df)
-            lm.fit(
-                robust=robust,
-                conf_int=conf_int,
-                summarize=False,
-                n_boot=n_boot,
-                n_jobs=n_jobs,
-                n_lags=n_lags,
+        if permute:
+            # sign-flip permutation test for all betas at once to replace p-values
+            if perm_on == "coef":
+                return_stat = "mean"
+                fit_stat = results["Estimate"].values
+            else:
+                return_stat = "t-stat"
+                fit_stat = results["T-stat"].values
+            perm_est, exact = _permute_sign(
+                betas,
+                permute,
+                return_stat=return_stat,
+                random_state=np.random.randint(np.iinfo(np.int32).max),
+                weights=self._first_level_weights,
             )
-            results.append(lm.coefs)
-            if permute:
-                # sign-flip permutation test for each beta instead to replace p-values
-                if perm_on == 'coef':
-                    return_stat = 'mean'
-                else:
-                    return_stat = 't-stat'
-                seeds = np.random.randint(np.iinfo(np.int32).max, size=permute)
-                par_for = Parallel(n_jobs=n_jobs, backend="multiprocessing")
-                perm_est = par_for(
-                    delayed(_permute_sign)(
-                        data=betas[:, i], seed=seeds[j], return_stat=return_stat
-                    )
-                    for j in range(permute)
-                )
-                perm_est = np.array(perm_est)
-                if perm_on == "coef":
-                    perm_ps.append(_perm_find(perm_est, betas[:, i].mean()))
-                else:
-                    perm_ps.append(_perm_find(perm_est, lm.coefs["T-stat"].values))
+            if exact:
+                # All sign patterns were enumerated and the first one is the unpermuted data, which the observed statistic stands in for like in the sampled case
+                permute = perm_est.shape[0]
+                self.sig_type = "permutation (exact, " + str(permute) + ")"
+                null, observed = np.abs(perm_est[1:]), np.abs(fit_stat)
+                extreme = (null >= observed) | np.isclose(null, observed)
+                perm_ps = list((np.sum(extreme, axis=0) + 1) / float(permute))
+            else:
+                perm_ps = [
+                    _perm_find(perm_est[:, i], fit_stat[i])
+                    for i in range(betas.shape[1])
+                ]
 
-        results = pd.concat(results, axis=0)
         ivs = self.formula.split("~")[-1].strip().split("+")
         ivs = [e.strip() for e in ivs]
         if to_corrs:
@@ -249,14 +391,13 @@ class Lm2(object):
                 intercept_pd[c] = np.nan
             intercept_pd = pd.DataFrame(intercept_pd, index=[0])
             results = pd.concat([intercept_pd, results], ignore_index=True)
-        results.index = x.columns
+        results.index = columns
         self.coefs = results
         if to_corrs:
             self.fixef = pd.DataFrame(betas, columns=ivs)
         else:
-            self.fixef = pd.DataFrame(betas, columns=x.columns)
-        self.fixef.index = self.data[self.group].unique()
-        self.fixef.index.name = self.group
+            self.fixef = pd.DataFrame(betas, columns=columns)
+        self.fixef.index = groups.rename(self.group)
         if permute:
             # get signifance stars
             sig = [_sig_stars(elem) for elem in perm_ps]
@@ -287,12 +428,27 @@ class Lm2(object):
             ]
         self.fitted = True
 
-        # Need to figure out how best to compute predictions and residuals. Should test how Lmer does it, i.e. BLUPs or fixed effects?
-        # Option 1) Use only second-level estimates
-        # Option 2) Use only first-level estimates and make separate predictions per group
-        # self.resid = res
-        # self.data['fits'] = y.squeeze() - res
-        # self.data['residuals'] = res
+        # Fits and residuals from the stored first-level design, using each group's own estimates and using only the population estimates
+        if design is not None:
+            X, Y, codes, rows = design
+            self.fits = np.einsum("ij,ij->i", X, betas[codes])
+            self.residuals = Y - self.fits
+            self.population_fits = np.dot(X, self.coefs["Estimate"].values)
+            self.population_residuals = Y - self.population_fits
+            if fits_to_data:
+                # Written by position since index labels need not be unique; rows patsy dropped get NaN
+                for name, vals in [("fits", self.fits), ("residuals", self.residuals)]:
+                    col = np.full(self.data.shape[0], np.nan)
+                    col[rows] = vals
+                    self.data[name] = col
+        else:
+            self.fits = None
+            self.residuals = None
+            self.population_fits = None
+            self.population_residuals = None
+            if self.data is not None:
+                # Don't leave fits from a previous call behind
+                self.data = self.data.drop(columns=["fits", "residuals"], errors="ignore")
 
         # Fit statistics
         # self.rsquared = np.nan
@@ -306,6 +462,84 @@ class Lm2(object):
         if summarize:
             return self.summary()
 
+    def _fit_first_level(self, to_corrs, ztrans_corrs):
+        """
+        Fit a separate regression (or compute correlations) for every group. Results are cached on the formula, grouping, rank and to_corrs settings and a fingerprint of the data columns they use, so refitting with different second-level options (e.g. robust, permute or conf_int) reuses them.
+
+        Returns:
+            Multiple:
+
+                - **betas** (*np.ndarray*): groups x coefficients array of first-level estimates
+
+                - **columns** (*pd.Index*): design matrix column names
+
+                - **design** (*tuple*): design matrix, dv, group codes and position in data of each row used in the first-level regressions; None for correlations or models created from first-level estimates
+
+                - **groups** (*pd.Index*): group of each row of betas, i.e. the groups with at least one row left after patsy drops missing values
+
+                - **rows** (*np.ndarray*): positions in data of the rows used in the first-level regressions; None for models created from first-level estimates
+        """
+
+        if self.data is None:
+            # Model was created from first-level estimates, which are saved with the model
+            estimates = self._first_level_estimates
+            betas = estimates.values.astype(float)
+            if to_corrs:
+                # Streamed correlations have no estimate for the intercept
+                betas = betas[:, 1:]
+            return betas, estimates.columns, None, estimates.index, None
+
+        # Only the columns the first level uses are fingerprinted, which also leaves out the fits and residuals written into the data
+        cols = _formula_cols(self.formula, self.data.columns)
+        if self.group not in cols:
+            cols.append(self.group)
+        cache_key = (
+            self.formula,
+            self.group,
+            self.ranked_data,
+            to_corrs,
+            ztrans_corrs if to_corrs else None,
+            _data_fingerprint(self.data[cols]),
+        )
+        if self._first_level_cache is not None:
+            cached_key, betas, columns, design, groups, rows = self._first_level_cache
+            if cached_key == cache_key:
+                return betas.copy(), columns, design, groups, rows
+
+        # Build a single design matrix for all groups
+        if self.ranked_data:
+            ddat = self.data.groupby(self.group, sort=False).rank()
+            ddat[self.group] = self.data[self.group].values
+        else:
+            ddat = self.data
+        # Rows are tracked by position rather than index label, which need not be unique
+        y, x = dmatrices(
+            self.formula, ddat.reset_index(drop=True), 1, return_type="dataframe"
+        )
+        rows = x.index.values
+        codes, groups = pd.factorize(self.data[self.group].values[rows])
+        groups = pd.Index(groups)
+
+        if to_corrs:
+            # Semi/partial correlation estimates for every group from per-group covariance matrices
+            # Reminder len(betas) == len(betas) - 1, from normal OLS, since corr of intercept is not computed
+            betas = _corr_groups(x.values, y.values[:, 0], codes, to_corrs)
+            if ztrans_corrs:
+                betas = np.arctanh(betas)
+            design = None
+        else:
+            # Solve each group's regression in batches
+            betas = _ols_groups(x.values, y.values[:, 0], codes)
+            # Keep the design so fits and residuals don't need another pass over the data
+            design = (x.values, y.values[:, 0], codes, rows)
+
+        # Get the model matrix formula from patsy to make it more reliable to set the results dataframe index like Lmer
+        if self.ranked_data:
+            y, x = dmatrices(self.formula, self.data, 1, return_type="dataframe")
+
+        self._first_level_cache = (cache_key, betas, x.columns, design, groups, rows)
+        return betas.copy(), x.columns, design, groups, rows
+
     def summary(self):
         """
         Summarize the output of a fitted model.
@@ -325,11 +559,19 @@ class Lm2(object):
                 self.se_type, self.ci_type, self.sig_type
             )
         )
-        print(
-            "Number of observations: %s\t Groups: %s\n"
-            % (self.data.shape[0], {str(self.group): self.data[self.group].nunique()})
-        )
+        if self.data is not None:
+            print(
+                "Number of observations: %s\t Groups: %s\n"
+                % (
+                    self.data.shape[0],
+                    {str(self.group): self.data[self.group].nunique()},
+                )
+            )
+        else:
+            print("Groups: %s\n" % {str(self.group): self.fixef.shape[0]})
         print("Fixed effects:\n")
+        if self._first_level_weights is not None:
+            print("Note: estimates are weighted by the precision of first-level estimates")
         if self.iscorrs:
             if self.iscorrs == "semi":
                 corr = "semi-partial"
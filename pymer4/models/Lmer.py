@@ -5,17 +5,34 @@ Pymer4 Lmer Class
 Main class to wrap R's lme4 library
 """
 
+import os
+import shutil
+import tempfile
 from copy import copy
-from rpy2.robjects.packages import importr
 import rpy2.robjects as robjects
 from rpy2.robjects import pandas2ri
+from rpy2.robjects.conversion import localconverter
 from rpy2 import rinterface_lib
 import warnings
 import numpy as np
 import pandas as pd
+from scipy.special import expit
 import matplotlib.pyplot as plt
 import seaborn as sns
-from ..utils import _sig_stars, _perm_find, _return_t, _to_ranks_by_group
+from joblib import Parallel, delayed
+from ..utils import (
+    _sig_stars,
+    _perm_find,
+    _to_ranks_by_group,
+    _chunk_perm_lmer,
+    _chunk_seeds,
+    _formula_cols,
+    _data_fingerprint,
+    _r_matrix,
+    _r_table,
+    _r_func,
+    _r_package,
+)
 
 pandas2ri.activate()
 
@@ -87,6 +104,7 @@ class Lmer(object):
         self.model_obj = None
         self.factors = None
         self.ranked_data = False
+        self._r_data_cache = None
         self.marginal_estimates = None
         self.marginal_contrasts = None
         self.sig_type = None
@@ -98,6 +116,22 @@ class Lmer(object):
         )
         return out
 
+    def _r_data(self):
+        """
+        Return the columns of the model data that the formula refers to as an R data.frame. The conversion is cached against a fingerprint of those columns, so repeated fits, refits and permutations reuse it, and it's redone whenever they change.
+
+        Returns:
+            rpy2.robjects.DataFrame: R copy of the model data
+        """
+
+        cols = _formula_cols(self.formula, self.data.columns)
+        fingerprint = _data_fingerprint(self.data[cols])
+        if self._r_data_cache is None or self._r_data_cache[0] != fingerprint:
+            with localconverter(robjects.default_converter + pandas2ri.converter):
+                r_data = robjects.conversion.py2rpy(self.data[cols])
+            self._r_data_cache = (fingerprint, r_data)
+        return self._r_data_cache[1]
+
     def _make_factors(self, factor_dict, ordered=False):
         """
         Covert specific columns to R-style factors. Default scheme is dummy coding where reference is 1st level provided. Alternative is orthogonal polynomial contrasts. User can also specific custom contrasts.
@@ -107,45 +141,25 @@ class Lmer(object):
             ordered: (bool) whether to interpret factor_dict values as dummy-coded (1st list item is reference level) or as polynomial contrasts (linear contrast specified by ordered of list items)
 
         Returns:
-            pandas.core.frame.DataFrame: copy of original data with factorized columns
+            rpy2.robjects.DataFrame: R copy of the model data with factorized columns
         """
-        if ordered:
-            rstring = """
-                function(df,f,lv){
-                df[,f] <- factor(df[,f],lv,ordered=T)
-                df
-                }
-            """
-        else:
-            rstring = """
-                function(df,f,lv){
-                df[,f] <- factor(df[,f],lv,ordered=F)
-                df
-                }
-            """
-
-        c_rstring = """
-            function(df,f,c){
-            contrasts(df[,f]) <- c(c)
-            df
-            }
-            """
-
-        factorize = robjects.r(rstring)
-        contrastize = robjects.r(c_rstring)
-        df = copy(self.data)
-        for k in factor_dict.keys():
-            df[k] = df[k].astype(str)
-
-        r_df = df
-        for k, v in factor_dict.items():
-            if isinstance(v, list):
-                r_df = factorize(r_df, k, v)
-            elif isinstance(v, dict):
-                levels = list(v.keys())
-                contrasts = np.array(list(v.values()))
-                r_df = factorize(r_df, k, levels)
-                r_df = contrastize(r_df, k, contrasts)
+
+        factorize = _r_func("factorize")
+        contrastize = _r_func("contrastize")
+
+        # Start from the cached R data and only send the factor columns (as strings) across; results stay in R
+        r_df = self._r_data()
+        with localconverter(robjects.default_converter):
+            for k, v in factor_dict.items():
+                vals = robjects.StrVector(self.data[k].astype(str).values)
+                if isinstance(v, list):
+                    levels = robjects.StrVector([str(elem) for elem in v])
+                    r_df = factorize(r_df, k, vals, levels, ordered)
+                elif isinstance(v, dict):
+                    levels = robjects.StrVector([str(elem) for elem in v.keys()])
+                    contrasts = robjects.FloatVector(list(v.values()))
+                    r_df = factorize(r_df, k, vals, levels, ordered)
+                    r_df = contrastize(r_df, k, contrasts)
         return r_df
 
     def _refit_orthogonal(self):
@@ -185,13 +199,7 @@ class Lmer(object):
         elif not self.fitted:
             raise ValueError("Model must be fit before ANOVA table can be generated!")
 
-        rstring = """
-            function(model){
-            df<- anova(model)
-            df
-            }
-        """
-        anova = robjects.r(rstring)
+        anova = _r_func("anova")
         self.anova_results = anova(self.model_obj)
         if self.anova_results.shape[1] == 6:
             self.anova_results.columns = [
@@ -220,16 +228,6 @@ class Lmer(object):
             )
         return self.anova_results
 
-    def _get_ngrps(self):
-        """Get the groups information from the model as a dictionary
-        """
-        rstring = "function(model){data.frame(unclass(summary(model))$ngrps)}"
-        get_ngrps = robjects.r(rstring)
-        res = get_ngrps(self.model_obj)
-        if len(res.columns) != 1:
-            raise Exception("Appears there's been another rpy2 or lme4 api change.")
-        self.grps = res.to_dict()[res.columns[0]]
-
     def _set_R_stdout(self, verbose):
         """Adjust whether R prints to the console (often as a duplicate) based on the verbose flag of a method call. Reference to rpy2 interface here: https://bit.ly/2MsrufO"""
 
@@ -263,6 +261,7 @@ class Lmer(object):
         no_warnings=False,
         control="",
         old_optimizer=False,
+        n_jobs=1,
     ):
         """
         Main method for fitting model object. Will modify the model's data attribute to add columns for residuals and fits for convenience.
@@ -282,6 +281,7 @@ class Lmer(object):
             no_warnings (bool): turn off auto-printing warnings messages; warnings are always stored in the .warnings attribute; default False
             control (str): string containing options to be passed to (g)lmer control. See https://bit.ly/2OQONTH for options
             old_optimizer (bool): use the old bobyqa optimizer that was the default in lmer4 <= 1.1_20, i.e. prior to 02/04/2019. This is not compatible with the control setting as it's meant to be a quick shorthand (e.g. to reproduce previous model results). However, the same setting can be manually requested using the control option if preferred. (For optimizer change discussions see: https://bit.ly/2MrP9Nq and https://bit.ly/2Vx5jte )
+            n_jobs (int): number of worker processes for permutations, each running its own R session; default 1
 
         Returns:
             pd.DataFrame: R/statsmodels style summary
@@ -336,13 +336,14 @@ class Lmer(object):
             dat = self._make_factors(factors, ordered)
             self.factors = factors
         else:
-            dat = self.data
+            dat = self._r_data()
         if rank:
             if not rank_group:
                 raise ValueError("rank_group must be provided if rank is True")
             dat = _to_ranks_by_group(
                 self.data, rank_group, self.formula, rank_exclude_cols
             )
+            dat = dat[_formula_cols(self.formula, dat.columns)]
             if factors and (set(factors.keys()) != set(rank_exclude_cols)):
                 w = "Factors and ranks requested, but factors are not excluded from rank conversion. Are you sure you wanted to do this?"
                 warnings.warn(w)
@@ -363,7 +364,7 @@ class Lmer(object):
                     + " confidence intervals...\n"
                 )
 
-            lmer = importr("lmerTest")
+            lmer = _r_package("lmerTest")
             lmc = robjects.r(f"lmerControl({control})")
             self.model_obj = lmer.lmer(self.formula, data=dat, REML=REML, control=lmc)
         else:
@@ -373,7 +374,7 @@ class Lmer(object):
                     + conf_int
                     + " confidence intervals...\n".format(self.family)
                 )
-            lmer = importr("lme4")
+            lmer = _r_package("lme4")
             if self.family == "inverse_gaussian":
                 _fam = "inverse.gaussian"
             elif self.family == "gamma":
@@ -385,46 +386,34 @@ class Lmer(object):
                 self.formula, data=dat, family=_fam, control=lmc
             )
         
-        # Store design matrix and get number of IVs for inference
-        stats = importr("stats")
-        self.design_matrix = stats.model_matrix(self.model_obj)
-        num_IV = self.design_matrix.shape[1]
-
         if permute and verbose:
             print("Using {} permutations to determine significance...".format(permute))
-        base = importr("base")
-
-        summary = base.summary(self.model_obj)
-        unsum = base.unclass(summary)
-
-        # Do scalars first cause they're easier
 
-        # Get group names separately cause rpy2 > 2.9 is weird and doesnt return them above
-        try:
-            self._get_ngrps()
-        except AttributeError:
-            raise Exception(
-                "You appear to have an old version of rpy2, upgrade to >3.0"
+        # Pull everything needed from the fitted model in a single R call that returns plain vectors and matrices
+        extract_func = _r_func("extract_lmer")
+        # Unpack without rpy2's pandas conversion so each piece is converted exactly once
+        with localconverter(robjects.default_converter):
+            out = extract_func(self.model_obj, conf_int, n_boot)
+            self.grps = dict(
+                zip(out.rx2("ngrps_names"), [int(n) for n in out.rx2("ngrps")])
             )
+            self.AIC = out.rx2("AIC")[0]
+            self.logLike = out.rx2("logLike")[0]
+            # lme4 printed messages (e.g. convergence info is usually here instead of in warnings) and warnings
+            fit_messages_warnings = list(out.rx2("warnings")) + list(
+                out.rx2("messages")
+            )
+            self.design_matrix = _r_matrix(out.rx2("design_matrix"))
+            coefs = _r_table(out.rx2("coefs"))
+            varcor = out.rx2("varcor")
+            varcor = pd.DataFrame(
+                {k: np.array(varcor.rx2(k)) for k in ["grp", "var1", "var2", "vcov", "sdcor"]}
+            )
+            fixefs = [_r_table(f) for f in out.rx2("fixef")]
+            ranefs = [_r_table(r) for r in out.rx2("ranef")]
+            residuals = np.array(out.rx2("residuals"))
+            fits = np.array(out.rx2("fits"))
 
-        self.AIC = unsum.rx2("AICtab")[0]
-        self.logLike = unsum.rx2("logLik")[0]
-
-        # First check for lme4 printed messages (e.g. convergence info is usually here instead of in warnings)
-        fit_messages = unsum.rx2("optinfo").rx2("conv").rx2("lme4").rx2("messages")
-        # Then check warnings for additional stuff
-        fit_warnings = unsum.rx2("optinfo").rx2("warnings")
-
-        try:
-            fit_warnings = [fw for fw in fit_warnings]
-        except TypeError:
-            fit_warnings = []
-        try:
-            fit_messages = [fm for fm in fit_messages]
-        except TypeError:
-            fit_messages = []
-
-        fit_messages_warnings = fit_warnings + fit_messages
         if fit_messages_warnings:
             self.warnings.extend(fit_messages_warnings)
             if not no_warnings:
@@ -436,33 +425,15 @@ class Lmer(object):
                         print(warning + " \n")
         else:
             self.warnings = []
-        
+
+        num_IV = self.design_matrix.shape[1]
+
         # Coefficients, and inference statistics
         if num_IV != 0:
             if self.family in ["gaussian", "gamma", "inverse_gaussian", "poisson"]:
 
-                rstring = (
-                    """
-                    function(model){
-                    out.coef <- data.frame(unclass(summary(model))$coefficients)
-                    out.ci <- data.frame(confint(model,method='"""
-                    + conf_int
-                    + """',nsim="""
-                    + str(n_boot)
-                    + """))
-                    n <- c(rownames(out.ci))
-                    idx <- max(grep('sig',n))
-                    out.ci <- out.ci[-seq(1:idx),]
-                    out <- cbind(out.coef,out.ci)
-                    list(out,rownames(out))
-                    }
-                """
-                )
-                estimates_func = robjects.r(rstring)
-                out_summary, out_rownames = estimates_func(self.model_obj)
-                df = out_summary
+                df = coefs
                 dfshape = df.shape[1]
-                df.index = out_rownames
 
                 # gaussian
                 if dfshape == 7:
@@ -514,40 +485,7 @@ class Lmer(object):
 
             elif self.family == "binomial":
 
-                rstring = (
-                    """
-                    function(model){
-                    out.coef <- data.frame(unclass(summary(model))$coefficients)
-                    out.ci <- data.frame(confint(model,method='"""
-                    + conf_int
-                    + """',nsim="""
-                    + str(n_boot)
-                    + """))
-                    n <- c(rownames(out.ci))
-                    idx <- max(grep('sig',n))
-                    out.ci <- out.ci[-seq(1:idx),]
-                    out <- cbind(out.coef,out.ci)
-                    odds <- exp(out.coef[1])
-                    colnames(odds) <- "OR"
-                    probs <- data.frame(sapply(out.coef[1],plogis))
-                    colnames(probs) <- "Prob"
-                    odds.ci <- exp(out.ci)
-                    colnames(odds.ci) <- c("OR_2.5_ci","OR_97.5_ci")
-                    probs.ci <- data.frame(sapply(out.ci,plogis))
-                    if(ncol(probs.ci) == 1){
-                      probs.ci = t(probs.ci)
-                    }
-                    colnames(probs.ci) <- c("Prob_2.5_ci","Prob_97.5_ci")
-                    out <- cbind(out,odds,odds.ci,probs,probs.ci)
-                    list(out,rownames(out))
-                    }
-                """
-                )
-
-                estimates_func = robjects.r(rstring)
-                out_summary, out_rownames = estimates_func(self.model_obj)
-                df = out_summary
-                df.index = out_rownames
+                df = coefs
                 df.columns = [
                     "Estimate",
                     "SE",
@@ -555,13 +493,14 @@ class Lmer(object):
                     "P-val",
                     "2.5_ci",
                     "97.5_ci",
-                    "OR",
-                    "OR_2.5_ci",
-                    "OR_97.5_ci",
-                    "Prob",
-                    "Prob_2.5_ci",
-                    "Prob_97.5_ci",
                 ]
+                # Odds ratios and probabilities from the log-odds estimates and intervals
+                df["OR"] = np.exp(df["Estimate"])
+                df["OR_2.5_ci"] = np.exp(df["2.5_ci"])
+                df["OR_97.5_ci"] = np.exp(df["97.5_ci"])
+                df["Prob"] = expit(df["Estimate"])
+                df["Prob_2.5_ci"] = expit(df["2.5_ci"])
+                df["Prob_97.5_ci"] = expit(df["97.5_ci"])
                 df = df[
                     [
                         "Estimate",
@@ -580,22 +519,26 @@ class Lmer(object):
                 ]
 
             if permute:
-                perm_dat = dat.copy()
-                dv_var = self.formula.split("~")[0].strip()
-                grp_vars = list(self.grps.keys())
-                perms = []
-                for i in range(permute):
-                    perm_dat[dv_var] = perm_dat.groupby(grp_vars)[dv_var].transform(
-                        lambda x: x.sample(frac=1)
-                    )
-                    if self.family == "gaussian":
-                        perm_obj = lmer.lmer(self.formula, data=perm_dat, REML=REML)
-                    else:
-                        perm_obj = lmer.glmer(
-                            self.formula, data=perm_dat, family=_fam
+                # Save a plain lme4 copy of the fitted model for the workers along with its response and the clusters to shuffle within, aligned to the rows actually used in the fit
+                perm_setup = _r_func("perm_setup")
+                model_dir = tempfile.mkdtemp(prefix="pymer4_")
+                model_file = os.path.join(model_dir, "model.rds")
+                try:
+                    y, codes = perm_setup(self.model_obj, model_file)
+                    y, codes = np.asarray(y, dtype=float), np.asarray(codes)
+                    # Seed each permutation so results don't depend on how they're split across workers
+                    seeds = np.random.randint(np.iinfo(np.int32).max, size=permute)
+                    # Chunks of permutations run in worker processes that each keep a warm R session with lme4 loaded; only the permuted responses change between refits
+                    par_for = Parallel(n_jobs=n_jobs, backend="loky")
+                    perms = par_for(
+                        delayed(_chunk_perm_lmer)(
+                            model_file=model_file, y=y, codes=codes, seeds=seed_chunk
                         )
-                    perms.append(_return_t(perm_obj))
-                perms = np.array(perms)
+                        for seed_chunk in _chunk_seeds(seeds, y.shape[0], n_jobs)
+                    )
+                finally:
+                    shutil.rmtree(model_dir, ignore_errors=True)
+                perms = np.vstack(perms)
                 pvals = []
                 for c in range(df.shape[0]):
                     if self.family in ["gaussian", "gamma", "inverse_gaussian"]:
@@ -644,18 +587,16 @@ class Lmer(object):
         self.fitted = True
 
         # Random effect variances and correlations
-        df = base.data_frame(unsum.rx2("varcor"))
-        ran_vars = df.query("(var2 == 'NA') | (var2 == 'N')").drop("var2", axis=1)
-        ran_vars.index = ran_vars["grp"]
-        ran_vars.drop("grp", axis=1, inplace=True)
+        df = varcor
+        is_var = df["var2"] == ""
+        ran_vars = df.loc[is_var, ["var1", "vcov", "sdcor"]]
+        ran_vars.index = df.loc[is_var, "grp"]
         ran_vars.columns = ["Name", "Var", "Std"]
         ran_vars.index.name = None
-        ran_vars.replace("NA", "", inplace=True)
 
-        ran_corrs = df.query("(var2 != 'NA') & (var2 != 'N')").drop("vcov", axis=1)
+        ran_corrs = df.loc[~is_var, ["var1", "var2", "sdcor"]]
         if ran_corrs.shape[0] != 0:
-            ran_corrs.index = ran_corrs["grp"]
-            ran_corrs.drop("grp", axis=1, inplace=True)
+            ran_corrs.index = df.loc[~is_var, "grp"]
             ran_corrs.columns = ["IV1", "IV2", "Corr"]
             ran_corrs.index.name = None
         else:
@@ -665,14 +606,6 @@ class Lmer(object):
         self.ranef_corr = ran_corrs
 
         # Cluster (e.g subject) level coefficients
-        rstring = """
-            function(model){
-            out <- coef(model)
-            out
-            }
-        """
-        fixef_func = robjects.r(rstring)
-        fixefs = fixef_func(self.model_obj)
         if len(fixefs) > 1:
             if self.coefs is not None:
                 f_corrected_order = []
@@ -698,32 +631,13 @@ class Lmer(object):
         # This also handles cases in which random slope terms exist in the model without corresponding fixed effects terms, which generates extra columns in this dataframe. By default put those columns *after* the fixed effect columns of interest (i.e. population coefs)
 
         # Cluster (e.g subject) level random deviations
-        rstring = """
-            function(model){
-            uniquify <- function(df){
-            colnames(df) <- make.unique(colnames(df))
-            df
-            }
-            out <- lapply(ranef(model),uniquify)
-            out
-            }
-        """
-        ranef_func = robjects.r(rstring)
-        ranefs = ranef_func(self.model_obj)
         if len(ranefs) > 1:
-            self.ranef = list(ranefs)
+            self.ranef = ranefs
         else:
             self.ranef = ranefs[0]
 
         # Model residuals
-        rstring = """
-            function(model){
-            out <- resid(model)
-            out
-            }
-        """
-        resid_func = robjects.r(rstring)
-        self.residuals = resid_func(self.model_obj)
+        self.residuals = residuals
         try:
             self.data["residuals"] = copy(self.residuals)
         except ValueError as e:  # NOQA
@@ -732,14 +646,7 @@ class Lmer(object):
             )
 
         # Model fits
-        rstring = """
-            function(model){
-            out <- fitted(model)
-            out
-            }
-        """
-        fit_func = robjects.r(rstring)
-        self.fits = fit_func(self.model_obj)
+        self.fits = fits
         try:
             self.data["fits"] = copy(self.fits)
         except ValueError as e:  # NOQA
@@ -770,25 +677,8 @@ class Lmer(object):
         if not isinstance(num_datasets, int):
             raise ValueError("num_datasets must be an integer")
 
-        if use_rfx:
-            re_form = "NULL"
-        else:
-            re_form = "NA"
-
-        rstring = (
-            """
-            function(model){
-            out <- simulate(model,"""
-            + str(num_datasets)
-            + """,allow.new.levels=TRUE,re.form="""
-            + re_form
-            + """)
-            out
-            }
-        """
-        )
-        simulate_func = robjects.r(rstring)
-        sims = simulate_func(self.model_obj)
+        simulate_func = _r_func("simulate")
+        sims = simulate_func(self.model_obj, num_datasets, use_rfx)
         return sims
 
     def predict(self, data, use_rfx=False, pred_type="response", verbose=False):
@@ -817,25 +707,12 @@ class Lmer(object):
                     "Column names are missing random effects model grouping terms!"
                 )
 
-            re_form = "NULL"
+        predict_func = _r_func("predict")
+        if data is self.data:
+            new_data = self._r_data()
         else:
-            re_form = "NA"
-
-        rstring = (
-            """
-            function(model,new){
-            out <- predict(model,new,allow.new.levels=TRUE,re.form="""
-            + re_form
-            + """,type='"""
-            + pred_type
-            + """')
-            out
-            }
-        """
-        )
-
-        predict_func = robjects.r(rstring)
-        preds = predict_func(self.model_obj, data)
+            new_data = data[_formula_cols(self.formula, data.columns)]
+        preds = predict_func(self.model_obj, new_data, use_rfx, pred_type)
         return preds
 
     def summary(self):
@@ -955,38 +832,10 @@ class Lmer(object):
                         if len(grouping_vars) > 1:
                             g1 = grouping_vars[0]
                             _conditional = "+".join(grouping_vars[1:])
-
-                            rstring = (
-                                """
-                                function(model){
-                                suppressMessages(library(emmeans))
-                                out <- emtrends(model,pairwise ~ """
-                                + g1
-                                + """|"""
-                                + _conditional
-                                + """,var='"""
-                                + cont
-                                + """',adjust='"""
-                                + p_adjust
-                                + """',options=list())
-                                out
-                                }"""
-                            )
+                            specs = "pairwise~" + g1 + "|" + _conditional
                         else:
-                            rstring = (
-                                """
-                                function(model){
-                                suppressMessages(library(emmeans))
-                                out <- emtrends(model,pairwise ~ """
-                                + grouping_vars[0]
-                                + """,var='"""
-                                + cont
-                                + """',adjust='"""
-                                + p_adjust
-                                + """',options=list())
-                                out
-                                }"""
-                            )
+                            specs = "pairwise~" + grouping_vars[0]
+                        res = _r_func("emtrends")(self.model_obj, specs, cont, p_adjust)
 
                     else:
                         raise ValueError(
@@ -998,41 +847,16 @@ class Lmer(object):
                 if grouping_vars:
                     # emmeans with pipe
                     _conditional = "+".join(grouping_vars)
-                    rstring = (
-                        """
-                        function(model){
-                        suppressMessages(library(emmeans))
-                        out <- emmeans(model,pairwise ~ """
-                        + _marginal
-                        + """|"""
-                        + _conditional
-                        + """, adjust='"""
-                        + p_adjust
-                        + """')
-                        out
-                        }"""
-                    )
+                    specs = "pairwise~" + _marginal + "|" + _conditional
                 else:
                     # emmeans without pipe
-                    rstring = (
-                        """
-                        function(model){
-                        suppressMessages(library(emmeans))
-                        out <- emmeans(model,pairwise ~ """
-                        + _marginal
-                        + """,adjust='"""
-                        + p_adjust
-                        + """')
-                        out
-                        }"""
-                    )
+                    specs = "pairwise~" + _marginal
+                res = _r_func("emmeans")(self.model_obj, specs, p_adjust)
             else:
                 raise ValueError("marginal_vars are not in model!")
 
-        func = robjects.r(rstring)
-        res = func(self.model_obj)
-        base = importr("base")
-        emmeans = importr("emmeans")
+        base = _r_package("base")
+        emmeans = _r_package("emmeans")
 
         # Marginal estimates
         self.marginal_estimates = base.summary(res)[0]
@@ -26,10 +26,11 @@ from pymer4.utils import (
     _welch_ingredients,
     # _get_params,
     _mean_diff,
+    _process_pool,
     # _lrt,
     # _sig_stars,
 )
-from joblib import Parallel, delayed
+from joblib import delayed
 
 MAX_INT = np.iinfo(np.int32).max
 
@@ -154,7 +155,7 @@ def cohens_d(
     if n_boot:
         random_state = _check_random_state(seed)
         seeds = random_state.randint(MAX_INT, size=n_boot)
-        par_for = Parallel(n_jobs=n_jobs, backend="multiprocessing")
+        par_for = _process_pool(n_jobs)
         boots = par_for(
             delayed(_cohens_d)(x, y, paired, equal_var, value, random_state=seeds[i])
             for i in range(n_boot)
@@ -276,7 +277,7 @@ def perm_test(
     else:
         random_state = _check_random_state(seed)
         seeds = random_state.randint(MAX_INT, size=n_perm)
-        par_for = Parallel(n_jobs=n_jobs, backend="multiprocessing")
+        par_for = _process_pool(n_jobs)
         perms = par_for(
             delayed(_perm_test)(x, y, stat, equal_var, random_state=seeds[i])
             for i in range(n_perm)
@@ -311,7 +312,7 @@ def _perm_test(x, y, stat, equal_var, random_state):
         if y is None:
             x = x * random_state.choice([1, -1], len(x))
         elif isinstance(y, (float, int)):
-            x -= y
+            x = x - y
             x = x * random_state.choice([1, -1], len(x))
         else:
             shuffled_combined = random_state.permutation(np.hstack([x, y]))
@@ -352,7 +353,7 @@ def boot_func(
     if n_boot:
         random_state = _check_random_state(seed)
         seeds = random_state.randint(MAX_INT, size=n_boot)
-        par_for = Parallel(n_jobs=n_jobs, backend="multiprocessing")
+        par_for = _process_pool(n_jobs)
         boots = par_for(
             delayed(_boot_func)(
                 x, y, func, func_args, paired, **func_args, random_state=seeds[i]
@@ -0,0 +1,79 @@
+from __future__ import division
+import os
+import pytest
+import numpy as np
+import pandas as pd
+from pymer4.models import Lm, Lm2
+from pymer4.utils import get_resource_path
+from pymer4.io import save_model, load_model
+
+
+def test_lm_partial_fit_after_load(tmp_path):
+
+    df = pd.read_csv(os.path.join(get_resource_path(), "sample_data.csv"))
+    full = Lm("DV ~ IV1 + IV3", data=df)
+    full.fit(summarize=False)
+
+    # A fitted model can be updated after it's loaded
+    model = Lm("DV ~ IV1 + IV3", data=df.iloc[:300])
+    model.fit(summarize=False)
+    filepath = os.path.join(str(tmp_path), "model.h5")
+    save_model(model, filepath)
+    model = load_model(filepath)
+    model.partial_fit(df.iloc[300:400])
+    assert "fits" not in model.data.columns
+    with pytest.raises(RuntimeError):
+        model.to_corrs()
+
+    # So can a model that was already updated before it was saved
+    save_model(model, filepath)
+    model = load_model(filepath)
+    model.partial_fit(df.iloc[400:])
+    assert np.allclose(model.coefs.iloc[:, :-1], full.coefs.iloc[:, :-1])
+
+    # Streamed models have no data to recover their design from
+    stream = Lm("DV ~ IV1 + IV3", data=None)
+    stream.fit_stream([df.iloc[:300]], summarize=False)
+    save_model(stream, filepath)
+    stream = load_model(filepath)
+    with pytest.raises(ValueError):
+        stream.partial_fit(df.iloc[300:])
+
+
+def test_lm2_from_first_level_after_load(tmp_path):
+
+    df = pd.read_csv(os.path.join(get_resource_path(), "sample_data.csv"))
+    model = Lm2("DV ~ IV3 + IV2", group="Group", data=df)
+    model.fit(summarize=False)
+
+    # Models created from first-level estimates can be refit after they're loaded
+    precomputed = Lm2.from_first_level(model.fixef)
+    precomputed.fit(robust="hc1", summarize=False)
+    filepath = os.path.join(str(tmp_path), "model.h5")
+    save_model(precomputed, filepath)
+    loaded = load_model(filepath)
+    loaded.fit(robust="hc1", summarize=False)
+    assert np.allclose(loaded.coefs.iloc[:, :-1], precomputed.coefs.iloc[:, :-1])
+    assert np.allclose(loaded.fixef.values, precomputed.fixef.values)
+
+
+def test_lm2_from_stream_after_load(tmp_path):
+
+    df = pd.read_csv(os.path.join(get_resource_path(), "sample_data.csv"))
+    filepath = os.path.join(str(tmp_path), "model.h5")
+
+    # Streamed models can be refit after they're loaded, including correlations which leave out the intercept
+    for to_corrs in [False, "semi"]:
+        frames = (grp for _, grp in df.groupby("Group", sort=False))
+        streamed = Lm2.from_stream("DV ~ IV3 + IV2", frames, group="Group", to_corrs=to_corrs)
+        streamed.fit(summarize=False)
+        save_model(streamed, filepath)
+        loaded = load_model(filepath)
+        loaded.fit(summarize=False)
+        assert list(loaded.coefs.index) == list(streamed.coefs.index)
+        assert np.allclose(
+            loaded.coefs.iloc[:, :-1].astype(float),
+            streamed.coefs.iloc[:, :-1].astype(float),
+            equal_nan=True,
+        )
+        assert np.allclose(loaded.fixef.values, streamed.fixef.values, equal_nan=True)
@@ -4,8 +4,12 @@ from pymer4.utils import get_resource_path
 import pandas as pd
 import numpy as np
 from scipy.special import logit
-from scipy.stats import ttest_ind
+from scipy.stats import ttest_ind, ttest_1samp
 import os
+import sys
+import itertools
+import time
+import pytest
 
 np.random.seed(10)
 
@@ -32,6 +36,197 @@ def test_gaussian_lm2():
     assert model.sig_type == "permutation (500)"
 
 
+def test_lm2_fits():
+
+    df = pd.read_csv(os.path.join(get_resource_path(), "sample_data.csv"))
+    model = Lm2("DV ~ IV3 + IV2", group="Group", data=df)
+    model.fit(summarize=False)
+
+    # First-level fits match fitting an Lm to a single group
+    group = df["Group"].iloc[0]
+    lm = Lm("DV ~ IV3 + IV2", data=df[df["Group"] == group])
+    lm.fit(summarize=False)
+    assert np.allclose(model.data.loc[df["Group"] == group, "fits"], lm.fits)
+    assert np.allclose(model.fits + model.residuals, df["DV"])
+
+    # Population fits only use the second-level estimates
+    X = np.column_stack([np.ones(df.shape[0]), df[["IV3", "IV2"]].values])
+    assert np.allclose(model.population_fits, np.dot(X, model.coefs["Estimate"]))
+    assert np.allclose(model.population_residuals, df["DV"] - model.population_fits)
+
+    # Fits can be kept out of the data
+    model = Lm2("DV ~ IV3 + IV2", group="Group", data=df)
+    model.fit(summarize=False, fits_to_data=False)
+    assert "fits" not in model.data.columns
+    assert model.fits.shape == (df.shape[0],)
+
+
+def test_lm2_to_corrs():
+
+    df = pd.read_csv(os.path.join(get_resource_path(), "sample_data.csv"))
+    # Correlations aren't defined for groups with a constant DV
+    df = df[df.groupby("Group")["DV"].transform("std") > 0]
+    model = Lm2("DV ~ IV3 + IV2", group="Group", data=df)
+
+    # First-level correlations match fitting an Lm to each group separately
+    for corr_type in ["semi", "partial"]:
+        model.fit(to_corrs=corr_type, ztrans_corrs=False, summarize=False)
+        assert model.fixef.shape == (df["Group"].nunique(), 2)
+        assert np.isnan(model.coefs.loc["Intercept", "Estimate"])
+        for group in model.fixef.index[:5]:
+            lm = Lm("DV ~ IV3 + IV2", data=df[df["Group"] == group])
+            lm.fit(summarize=False)
+            assert np.allclose(model.fixef.loc[group], lm.to_corrs(corr_type)[1:])
+
+    # Ranked data where a group's dv matches one of its predictors still gives finite correlations
+    model.fit(to_corrs="semi", rank=True, summarize=False)
+    assert np.isfinite(model.fixef.values).all()
+    assert np.isclose(model.coefs.loc["IV2", "Estimate"], 0.637, atol=0.001)
+
+
+def test_lm2_first_level_cache():
+
+    df = pd.read_csv(os.path.join(get_resource_path(), "sample_data.csv"))
+    model = Lm2("DV ~ IV3 + IV2", group="Group", data=df)
+    model.fit(summarize=False)
+    cached = model._first_level_cache
+
+    # Changing only second-level options reuses the first-level estimates
+    model.fit(robust="hc1", permute=500, summarize=False)
+    assert model._first_level_cache is cached
+    assert np.allclose(model.fixef, cached[1])
+    # So does changing data columns the model doesn't use
+    model.data["IV1"] += 1
+    model.fit(summarize=False)
+    assert model._first_level_cache is cached
+
+    # Changing first-level options or the data refits each group
+    model.fit(rank=True, summarize=False)
+    assert model._first_level_cache is not cached
+    cached = model._first_level_cache
+    model.data.loc[0, "DV"] += 1
+    model.fit(rank=True, summarize=False)
+    assert model._first_level_cache is not cached
+
+
+def test_lm2_dropped_group():
+
+    df = pd.read_csv(os.path.join(get_resource_path(), "sample_data.csv"))
+    groups = df["Group"].unique()
+    # Every row of the first group and the first row of the second are dropped for missing values
+    df.loc[df["Group"] == groups[0], "DV"] = np.nan
+    df["Site"] = df["Group"] % 3
+    df.loc[df.index[df["Group"] == groups[1]][0], ["DV", "Site"]] = [np.nan, -1]
+    model = Lm2("DV ~ IV3 + IV2", group="Group", data=df)
+    model.fit(summarize=False)
+    assert model.fixef.shape == (len(groups) - 1, 3)
+    assert list(model.fixef.index) == list(groups[1:])
+
+    # Clusters come from the rows used in the first-level fit
+    model.fit(robust="cluster", cluster="Site", summarize=False)
+    complete = Lm2("DV ~ IV3 + IV2", group="Group", data=df.dropna())
+    complete.fit(robust="cluster", cluster="Site", summarize=False)
+    assert np.allclose(model.coefs["SE"], complete.coefs["SE"])
+
+
+def test_lm2_duplicate_index():
+
+    df = pd.read_csv(os.path.join(get_resource_path(), "sample_data.csv"))
+    df["Site"] = df["Group"] % 3
+    df.loc[5, "DV"] = np.nan
+    model = Lm2("DV ~ IV3 + IV2", group="Group", data=df)
+
+    # Rows are matched by position, including when patsy drops some of them, so index labels don't need to be unique
+    duplicated = Lm2("DV ~ IV3 + IV2", group="Group", data=df.set_axis([0] * len(df)))
+    for kwargs in [{}, {"rank": True}, {"robust": "cluster", "cluster": "Site"}]:
+        model.fit(summarize=False, **kwargs)
+        duplicated.fit(summarize=False, **kwargs)
+        assert np.allclose(duplicated.coefs.iloc[:, :-1], model.coefs.iloc[:, :-1])
+        for col in ["fits", "residuals"]:
+            assert np.allclose(duplicated.data[col], model.data[col], equal_nan=True)
+
+
+def test_lm2_from_first_level():
+
+    df = pd.read_csv(os.path.join(get_resource_path(), "sample_data.csv"))
+    model = Lm2("DV ~ IV3 + IV2", group="Group", data=df)
+    model.fit(robust="hc1", summarize=False)
+
+    # Second-level results from precomputed estimates match fitting the raw data
+    precomputed = Lm2.from_first_level(model.fixef)
+    precomputed.fit(robust="hc1", summarize=False)
+    assert np.allclose(precomputed.coefs.iloc[:, :-1], model.coefs.iloc[:, :-1])
+    assert precomputed.group == "Group"
+    with pytest.raises(ValueError):
+        precomputed.fit(rank=True, summarize=False)
+
+    # Precision weighting matches a WLS intercept-only model
+    ses = pd.DataFrame(
+        np.random.uniform(0.5, 2, model.fixef.shape),
+        index=model.fixef.index,
+        columns=model.fixef.columns,
+    )
+    weighted = Lm2.from_first_level(model.fixef, ses=ses)
+    weighted.fit(summarize=False)
+    wls = Lm("Y ~ 1", data=pd.DataFrame({"Y": model.fixef["IV2"].values}))
+    wls.fit(weights=1 / ses["IV2"].values ** 2, summarize=False)
+    assert np.allclose(
+        weighted.coefs.loc["IV2"][:-1].astype(float), wls.coefs.iloc[0, :-1].astype(float)
+    )
+    weighted.fit(permute=500, summarize=False)
+    assert weighted.coefs["Perm-P-val"].between(0, 1).all()
+
+    # Exact tests compare the same observed statistic as sampled ones, i.e. the robust t-stat
+    few = Lm2.from_first_level(model.fixef.iloc[:8])
+    few.fit(robust="hc3", permute=500, summarize=False)
+    assert few.sig_type == "permutation (exact, 256)"
+    signs = np.array(list(itertools.product([1, -1], repeat=8)))
+    null = np.array([ttest_1samp(sign[:, np.newaxis] * few.fixef.values, 0)[0] for sign in signs[1:]])
+    expected = (np.sum(np.abs(null) >= np.abs(few.coefs["T-stat"].values) - 1e-8, axis=0) + 1) / 256
+    assert np.allclose(few.coefs["Perm-P-val"], expected)
+
+
+def test_lm2_from_stream(tmp_path, monkeypatch):
+
+    df = pd.read_csv(os.path.join(get_resource_path(), "sample_data.csv"))
+    model = Lm2("DV ~ IV3 + IV2", group="Group", data=df)
+    model.fit(robust="hc1", summarize=False)
+
+    # Streaming one file per group gives the same first- and second-level results
+    for name, grp in df.groupby("Group", sort=False):
+        grp.to_csv(os.path.join(tmp_path, "sub_{}.csv".format(name)), index=False)
+    streamed = Lm2.from_stream("DV ~ IV3 + IV2", str(tmp_path), group="Group", n_prefetch=2)
+    streamed.fit(robust="hc1", summarize=False)
+    assert np.allclose(
+        streamed.fixef.loc[model.fixef.index].values, model.fixef.values
+    )
+    assert np.allclose(streamed.coefs.iloc[:, :-1], model.coefs.iloc[:, :-1])
+    assert streamed.fits is None
+
+    # Generators of frames work the same way, with first-level options set up front
+    model.fit(rank=True, summarize=False)
+    frames = (grp for _, grp in df.groupby("Group", sort=False))
+    streamed = Lm2.from_stream(
+        "DV ~ IV3 + IV2", frames, group="Group", rank=True, n_prefetch=2
+    )
+    streamed.fit(summarize=False)
+    assert np.allclose(streamed.fixef.values, model.fixef.values)
+    assert np.allclose(streamed.coefs["Estimate"], model.coefs["Estimate"])
+
+    # Groups split across batches of frames are rejected
+    monkeypatch.setattr(sys.modules[Lm2.__module__], "MAX_CHUNK_BYTES", 1)
+    frames = [df.iloc[: len(df) // 2], df.iloc[len(df) // 2 :]]
+    with pytest.raises(ValueError):
+        Lm2.from_stream("DV ~ IV3 + IV2", frames, group="Group")
+
+    # Batch sizes count the memory held by string group labels
+    frames = [frame.assign(Group=frame["Group"].astype(str) * 10) for frame in frames]
+    shallow = frames[0].memory_usage(index=True).sum()
+    monkeypatch.setattr(sys.modules[Lm2.__module__], "MAX_CHUNK_BYTES", shallow + 1)
+    with pytest.raises(ValueError):
+        Lm2.from_stream("DV ~ IV3 + IV2", frames, group="Group")
+
+
 def test_gaussian_lm():
 
     df = pd.read_csv(os.path.join(get_resource_path(), "sample_data.csv"))
@@ -91,6 +286,139 @@ def test_gaussian_lm():
     assert all([np.allclose(a, b) for a, b in zip(wls, scit)])
 
 
+def test_lm_mass_univariate():
+
+    df = pd.read_csv(os.path.join(get_resource_path(), "sample_data.csv"))
+    dvs = ["DV", "IV2"]
+    results = Lm.mass_univariate("IV1 + IV3", data=df, dvs=dvs, robust="hc3")
+    assert results["Estimate"].shape == (2, 3)
+
+    # Should match fitting a separate model to each dv
+    for dv in dvs:
+        model = Lm(dv + " ~ IV1 + IV3", data=df)
+        model.fit(robust="hc3", summarize=False)
+        for col in ["Estimate", "SE", "T-stat", "P-val"]:
+            assert np.allclose(results[col].loc[dv], model.coefs[col])
+        assert np.allclose(results["rsquared"].loc[dv], model.rsquared)
+        assert np.allclose(results["rsquared_adj"].loc[dv], model.rsquared_adj)
+
+    # Arrays of dvs and permutation testing
+    results = Lm.mass_univariate(
+        "~ IV1 + IV3", data=df, dvs=df[dvs].values, permute=500
+    )
+    assert results["Perm-P-val"].shape == (2, 3)
+    assert ((results["Perm-P-val"] > 0) & (results["Perm-P-val"] <= 1)).all().all()
+    with pytest.raises(TypeError):
+        Lm.mass_univariate("~ IV1 + IV3", data=df, dvs=dvs, permute=True)
+
+
+def test_lm_fit_stream():
+
+    df = pd.read_csv(os.path.join(get_resource_path(), "sample_data.csv"))
+    model = Lm("DV ~ IV1 + IV3", data=df)
+    model.fit(summarize=False)
+    chunks = lambda: (df.iloc[i : i + 100] for i in range(0, df.shape[0], 100))
+
+    # Streaming over chunks should reproduce an in-memory fit
+    stream = Lm("DV ~ IV1 + IV3", data=None)
+    stream.fit_stream(chunks(), summarize=False)
+    assert stream.residuals is None
+    assert np.allclose(stream.coefs.iloc[:, :-1], model.coefs.iloc[:, :-1])
+    for stat in ["rsquared", "rsquared_adj", "logLike", "AIC", "BIC"]:
+        assert np.allclose(getattr(stream, stat), getattr(model, stat))
+
+    # Robust standard errors need a second pass
+    model.fit(robust="hc3", summarize=False)
+    stream.fit_stream(chunks, robust="hc3", summarize=False)
+    assert np.allclose(stream.coefs["SE"], model.coefs["SE"])
+    with pytest.raises(TypeError):
+        stream.fit_stream(chunks(), robust=True, summarize=False)
+
+
+def test_lm_partial_fit():
+
+    df = pd.read_csv(os.path.join(get_resource_path(), "sample_data.csv"))
+    model = Lm("DV ~ IV1 + IV3", data=df.iloc[:300])
+    model.fit(summarize=False)
+
+    # Appending rows should match a fit on all rows
+    model.partial_fit(df.iloc[300:400])
+    model.partial_fit(df.iloc[400:])
+    full = Lm("DV ~ IV1 + IV3", data=df)
+    full.fit(summarize=False)
+    assert np.allclose(model.coefs.iloc[:, :-1], full.coefs.iloc[:, :-1])
+    for stat in ["rsquared", "rsquared_adj", "logLike", "AIC", "BIC"]:
+        assert np.allclose(getattr(model, stat), getattr(full, stat))
+    # Fits and residuals of the original rows no longer describe the model
+    assert model.fits is None
+    assert "residuals" not in model.data.columns
+    with pytest.raises(RuntimeError):
+        model.to_corrs()
+
+    # Removing rows should match a fit on the remaining window
+    model.remove_rows(df.iloc[:300])
+    window = Lm("DV ~ IV1 + IV3", data=df.iloc[300:])
+    window.fit(summarize=False)
+    assert np.allclose(model.coefs.iloc[:, :-1], window.coefs.iloc[:, :-1])
+    assert np.allclose(model.rsquared, window.rsquared)
+
+    # Removing too many rows fails without changing the model
+    stats = {k: np.copy(v) for k, v in model._suff_stats.items()}
+    with pytest.raises(ValueError):
+        model.remove_rows(df.iloc[300:])
+    for k, v in stats.items():
+        assert np.allclose(model._suff_stats[k], v)
+    assert np.allclose(model.coefs.iloc[:, :-1], window.coefs.iloc[:, :-1])
+
+
+def test_lm_parallel_robust_permutation():
+
+    df = pd.read_csv(os.path.join(get_resource_path(), "sample_data.csv"))
+    model = Lm("DV ~ IV1 + IV3", data=df)
+
+    # Every permutation has its own seed, so splitting them across workers doesn't change the results
+    results = []
+    for n_jobs in [1, 2]:
+        np.random.seed(10)
+        model.fit(robust="hc1", permute=500, n_jobs=n_jobs, summarize=False)
+        results.append(model.coefs["Perm-P-val"].values)
+    assert model.sig_type == "permutation (500)"
+    assert np.allclose(results[0], results[1])
+
+
+@pytest.mark.skipif(os.cpu_count() < 2, reason="requires multiple cores")
+def test_lm_parallel_robust_permutation_speedup():
+
+    threadpoolctl = pytest.importorskip("threadpoolctl")
+    np.random.seed(10)
+    df = pd.DataFrame(np.random.normal(size=(20000, 4)), columns=["DV", "IV1", "IV2", "IV3"])
+    model = Lm("DV ~ IV1 + IV2 + IV3", data=df)
+
+    # Robust permutation tests should make use of multiple workers rather than falling back to a single one; BLAS is limited to one thread so it can't hide the difference
+    timings = []
+    with threadpoolctl.threadpool_limits(1):
+        for n_jobs in [1, 2]:
+            start = time.time()
+            model.fit(robust="hc1", permute=1000, n_jobs=n_jobs, summarize=False)
+            timings.append(time.time() - start)
+    assert timings[1] < 0.8 * timings[0]
+
+
+def test_lmm_permute():
+
+    df = pd.read_csv(os.path.join(get_resource_path(), "sample_data.csv"))
+    model = Lmer("DV ~ IV3 + IV2 + (1|Group)", data=df)
+    model.fit(summarize=False)
+    parametric = model.coefs.copy()
+
+    # Permutations spread over worker processes leave estimates untouched and replace p-values
+    model.fit(permute=50, n_jobs=2, summarize=False)
+    assert np.allclose(model.coefs["Estimate"], parametric["Estimate"])
+    assert np.allclose(model.coefs["T-stat"], parametric["T-stat"])
+    assert (model.coefs["Num_perm"] == 50).all()
+    assert model.coefs["Perm-P-val"].between(0, 1).all()
+
+
 def test_gaussian_lmm():
 
     df = pd.read_csv(os.path.join(get_resource_path(), "sample_data.csv"))
@@ -125,6 +453,13 @@ def test_gaussian_lmm():
     # Smoketest for old_optimizer
     model.fit(summarize=False, old_optimizer=True)
 
+    # The R copy of the data is reused across fits until the data change
+    r_data = model._r_data()
+    model.fit(summarize=False)
+    assert model._r_data() is r_data
+    model.data["DV"] = model.data["DV"] * 2
+    assert model._r_data() is not r_data
+
 
 def test_post_hoc():
     np.random.seed(1)
@@ -0,0 +1,284 @@
+from __future__ import division
+import os
+import pytest
+import numpy as np
+import pandas as pd
+from scipy.stats import pearsonr, ttest_1samp
+from pymer4.utils import (
+    _OLSSolver,
+    _robust_estimator,
+    _hac_n_lags,
+    _cluster_codes,
+    _cluster_dof,
+    _corrs_from_cov,
+    _corr_groups,
+    _ols_groups,
+    _ols_one_sample,
+    _permute_sign,
+    _process_pool,
+    _iter_frames,
+    _shuffle_within,
+    _formula_cols,
+)
+
+
+def test_ols_solver():
+    np.random.seed(10)
+    X = np.column_stack([np.ones(100), np.random.normal(size=(100, 3))])
+    Y = np.random.normal(size=(100, 4))
+
+    # Full rank designs use QR and rank deficient designs fall back to the SVD; both should match pinv
+    for x in [X, np.column_stack([X, 2 * X[:, 1]])]:
+        solver = _OLSSolver(x)
+        assert np.allclose(solver.coef(Y), np.dot(np.linalg.pinv(x), Y))
+        assert np.allclose(solver.coef(Y[:, 0]), np.dot(np.linalg.pinv(x), Y[:, 0]))
+        assert np.allclose(solver.bread, np.linalg.pinv(np.dot(x.T, x)))
+        hat = np.dot(x, np.dot(solver.bread, x.T))
+        assert np.allclose(solver.leverage, np.diag(hat))
+        assert solver.se(solver.resid(Y)).shape == (x.shape[1], Y.shape[1])
+    assert _OLSSolver(X).method == "qr"
+    assert _OLSSolver(np.column_stack([X, 2 * X[:, 1]])).method == "svd"
+
+
+def test_robust_estimator():
+    np.random.seed(10)
+    X = np.column_stack([np.ones(100), np.random.normal(size=(100, 2))])
+    res = np.random.normal(size=100)
+
+    # Compare against the dense n x n formulation of each sandwich estimator
+    bread = np.linalg.pinv(np.dot(X.T, X))
+    hat = np.diag(np.dot(X, np.dot(bread, X.T)))
+    dense_weights = {
+        "hc0": res ** 2,
+        "hc1": res ** 2 * X.shape[0] / (X.shape[0] - X.shape[1]),
+        "hc2": res ** 2 / (1 - hat),
+        "hc3": res ** 2 / (1 - hat) ** 2,
+    }
+    for estimator, weights in dense_weights.items():
+        meat = np.dot(np.dot(X.T, np.diag(weights)), X)
+        expected = np.sqrt(np.diag(np.dot(np.dot(bread, meat), bread)))
+        assert np.allclose(_robust_estimator(res, X, estimator), expected)
+
+    # Newey-West with multiple lags
+    n_lags = 3
+    lag_weights = 1 - np.arange(n_lags + 1.0) / (n_lags + 1.0)
+    meat = lag_weights[0] * np.dot(np.dot(X.T, np.diag(res ** 2)), X)
+    for l in range(1, n_lags + 1):
+        V = np.diag(res[l:] * res[:-l])
+        meat += lag_weights[l] * (
+            np.dot(np.dot(X[l:].T, V), X[:-l]) + np.dot(np.dot(X[:-l].T, V), X[l:])
+        )
+    expected = np.sqrt(np.diag(np.dot(np.dot(bread, meat), bread)))
+    assert np.allclose(_robust_estimator(res, X, "hac", n_lags=n_lags), expected)
+    assert np.allclose(
+        _robust_estimator(res, X, "hac", n_lags="auto"),
+        _robust_estimator(res, X, "hac", n_lags=_hac_n_lags(X.shape[0])),
+    )
+
+
+def test_cluster_robust_estimator():
+    np.random.seed(10)
+    X = np.column_stack([np.ones(100), np.random.normal(size=(100, 2))])
+    res = np.random.normal(size=100)
+    groups = pd.DataFrame(
+        {"g1": np.random.randint(0, 10, 100), "g2": np.random.choice(list("abcde"), 100)}
+    )
+
+    # One-way clustering against a pandas groupby reference
+    bread = np.linalg.pinv(np.dot(X.T, X))
+    u_clust = pd.DataFrame(res[:, np.newaxis] * X).groupby(groups["g1"]).sum().values
+    num_grps = groups["g1"].nunique()
+    meat = (num_grps / (num_grps - 1)) * (100 / 97) * np.dot(u_clust.T, u_clust)
+    expected = np.sqrt(np.diag(np.dot(np.dot(bread, meat), bread)))
+    codes = _cluster_codes(groups["g1"])
+    assert np.allclose(_robust_estimator(res, X, "cluster", cluster=codes), expected)
+
+    # Two-way clustering on the same dimension twice reduces to one-way clustering
+    codes = _cluster_codes(groups[["g1", "g1"]])
+    assert codes.shape == (100, 3)
+    assert np.allclose(_robust_estimator(res, X, "cluster", cluster=codes), expected)
+    codes = _cluster_codes(groups[["g1", "g2"]])
+    assert _robust_estimator(res, X, "cluster", cluster=codes).shape == (3,)
+
+    # Dof use the dimension with fewer clusters
+    assert _cluster_dof(_cluster_codes(groups["g1"]), 3) == 7
+    assert _cluster_dof(codes, 3) == 2
+
+
+def test_corrs_from_cov():
+    np.random.seed(10)
+    X = np.random.normal(size=(100, 3))
+    y = np.dot(X, [0.5, -0.2, 0.1]) + np.random.normal(size=100)
+
+    # Compare against correlating residuals after regressing out the other predictors
+    semi, partial = [], []
+    for c in range(X.shape[1]):
+        others = np.column_stack([np.ones(100), np.delete(X, c, axis=1)])
+        resid = lambda v: v - np.dot(others, np.dot(np.linalg.pinv(others), v))
+        semi.append(pearsonr(y, resid(X[:, c]))[0])
+        partial.append(pearsonr(resid(y), resid(X[:, c]))[0])
+    cov = np.cov(np.column_stack([X, y]), rowvar=False)
+    assert np.allclose(_corrs_from_cov(cov, "semi"), semi)
+    assert np.allclose(_corrs_from_cov(cov, "partial"), partial)
+
+    # Stacks of covariance matrices are handled together
+    stacked = _corrs_from_cov(np.stack([cov, cov]), "partial")
+    assert stacked.shape == (2, 3)
+    assert np.allclose(stacked[1], partial)
+
+    # A dv that's an exact linear function of the predictors still gives the residualized correlations
+    y = np.dot(X, [2, 0.5, 0]) + 1
+    cov = np.cov(np.column_stack([X, y]), rowvar=False)
+    semi = []
+    for c in range(X.shape[1]):
+        others = np.column_stack([np.ones(100), np.delete(X, c, axis=1)])
+        resid = X[:, c] - np.dot(others, np.dot(np.linalg.pinv(others), X[:, c]))
+        semi.append(pearsonr(y, resid)[0])
+    assert np.allclose(_corrs_from_cov(cov, "semi"), semi, atol=1e-8)
+    assert np.allclose(_corrs_from_cov(cov, "partial"), [1, 1, 0], atol=1e-8)
+
+
+def test_ols_groups():
+    np.random.seed(10)
+    codes = np.random.randint(0, 20, 500)
+    X = np.column_stack([np.ones(500), np.random.normal(size=(500, 2))])
+    y = np.random.normal(size=500)
+
+    expected = np.array(
+        [np.dot(np.linalg.pinv(X[codes == g]), y[codes == g]) for g in range(20)]
+    )
+    assert np.allclose(_ols_groups(X, y, codes), expected)
+    # A small memory ceiling splits groups across several batches
+    assert np.allclose(_ols_groups(X, y, codes, max_bytes=2000), expected)
+
+
+def test_process_pool():
+    from joblib import delayed
+
+    # Workers receive large arrays as read-only memory maps and small ones as copies
+    large, small = np.zeros(2 ** 18), np.zeros(10)
+    for arr, expected in [(large, True), (small, False)]:
+        shared = _process_pool(2)(delayed(isinstance)(arr, np.memmap) for _ in range(2))
+        assert shared == [expected] * 2
+
+
+def test_ols_one_sample():
+    np.random.seed(10)
+    data = np.random.normal(loc=[0, 0.5, 2], size=(30, 3))
+
+    # Parametric results match a one-sample t-test on each column
+    results = _ols_one_sample(data)
+    t, p = ttest_1samp(data, 0)
+    assert np.allclose(results["Estimate"], data.mean(axis=0))
+    assert np.allclose(results["T-stat"], t)
+    assert np.allclose(results["P-val"], p)
+    assert (results["DF"] == 29).all()
+
+    # Robust and bootstrapped variants match the single column computations
+    X = np.ones((30, 1))
+    res = data - data.mean(axis=0)
+    results = _ols_one_sample(data, robust="hc3", conf_int="boot", n_boot=100)
+    for i in range(3):
+        assert np.allclose(
+            results["SE"][i], _robust_estimator(res[:, i], X, "hc3")[0]
+        )
+    assert (results["2.5_ci"] < results["Estimate"]).all()
+    assert (results["97.5_ci"] > results["Estimate"]).all()
+
+    # A non-finite estimate only drops that row from its own column
+    data[4, 1] = np.nan
+    results = _ols_one_sample(data)
+    t, _ = ttest_1samp(data, 0, nan_policy="omit")
+    assert np.allclose(results["T-stat"], t)
+    assert list(results["DF"]) == [29, 28, 29]
+    perm_t, _ = _permute_sign(data, 100, return_stat="t-stat", random_state=1)
+    assert np.isfinite(perm_t).all()
+
+
+def test_permute_sign():
+    np.random.seed(10)
+    data = np.random.normal(loc=0.5, size=(20, 3))
+
+    # Random sign flips are shared across columns and t-stats match a one-sample t-test
+    perm_t, exact = _permute_sign(data, 500, return_stat="t-stat", random_state=1)
+    assert not exact and perm_t.shape == (500, 3)
+    perm_means, _ = _permute_sign(data, 500, return_stat="mean", random_state=1)
+    flips = np.random.RandomState(1).choice([1.0, -1.0], size=(500, 20))
+    assert np.allclose(perm_means, np.dot(flips, data) / 20)
+    assert np.allclose(perm_t[0], ttest_1samp(flips[0][:, np.newaxis] * data, 0)[0])
+
+    # Small samples enumerate every sign pattern, starting with the original data
+    perm_means, exact = _permute_sign(data[:4, 0], 500)
+    assert exact and perm_means.shape == (16,)
+    assert np.isclose(perm_means[0], data[:4, 0].mean())
+    assert len(np.unique(np.round(perm_means, 10))) == 16
+
+    # Enumerating all observations is still exact for a column with dropped observations, whose patterns repeat evenly
+    missing = data[:4, :2].copy()
+    missing[0, 1] = np.nan
+    perm_means, exact = _permute_sign(missing, 500)
+    expected, _ = _permute_sign(missing[1:, 1], 500)
+    assert exact and perm_means.shape == (16, 2)
+    assert np.allclose(np.sort(perm_means[:, 1]), np.sort(np.repeat(expected, 2)))
+
+
+def test_corr_groups():
+    np.random.seed(10)
+    codes = np.random.randint(0, 10, 300)
+    X = np.column_stack([np.ones(300), np.random.normal(size=(300, 2))])
+    y = np.dot(X, [1, 0.5, -0.5]) + np.random.normal(size=300)
+
+    # Per-group correlations match computing each group's covariance matrix separately
+    for corr_type in ["semi", "partial"]:
+        expected = np.array(
+            [
+                _corrs_from_cov(
+                    np.cov(np.column_stack([X[codes == g, 1:], y[codes == g]]), rowvar=False),
+                    corr_type,
+                )
+                for g in range(10)
+            ]
+        )
+        assert np.allclose(_corr_groups(X, y, codes, corr_type), expected)
+        assert np.allclose(_corr_groups(X, y, codes, corr_type, max_bytes=1000), expected)
+
+
+def test_iter_frames(tmp_path):
+    frames = [pd.DataFrame({"x": np.arange(i, i + 3)}) for i in range(5)]
+
+    # Prefetching keeps frames in order for iterables, callables and directories
+    for i, frame in enumerate(frames):
+        frame.to_csv(os.path.join(tmp_path, "part_{}.csv".format(i)), index=False)
+    for source in [frames, lambda: iter(frames), str(tmp_path)]:
+        for n_prefetch in [0, 2]:
+            loaded = list(_iter_frames(source, n_prefetch=n_prefetch))
+            assert len(loaded) == 5
+            assert all((a.values == b.values).all() for a, b in zip(loaded, frames))
+
+    # Errors raised while loading in the background reach the consumer
+    def broken():
+        yield frames[0]
+        raise IOError("unreadable")
+
+    with pytest.raises(IOError):
+        list(_iter_frames(broken, n_prefetch=2))
+
+
+def test_shuffle_within():
+    codes = np.repeat([2, 0, 1], [4, 5, 6])
+    y = np.arange(15.0)
+
+    # Values only move between positions of the same group and shuffles are reproducible
+    shuffled = _shuffle_within(y, codes, 1)
+    assert not np.array_equal(shuffled, y)
+    for g in range(3):
+        assert np.array_equal(np.sort(shuffled[codes == g]), y[codes == g])
+    assert np.array_equal(shuffled, _shuffle_within(y, codes, 1))
+
+
+def test_formula_cols():
+    columns = ["DV", "IV1", "IV2", "IV3", "Group", "Item", "Item.x", "fits"]
+
+    # Only whole names count, including inside functions, random effects and interactions
+    formula = "DV ~ IV3 + log(IV2) + (IV2|Group) + (1|IV3:Item.x)"
+    assert _formula_cols(formula, columns) == ["DV", "IV2", "IV3", "Group", "Item.x"]
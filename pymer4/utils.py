@@ -5,14 +5,31 @@ __all__ = [
     "_check_random_state",
     "_sig_stars",
     "_robust_estimator",
+    "_cluster_codes",
+    "_cluster_dof",
     "_chunk_boot_ols_coefs",
     "_chunk_perm_ols",
+    "_chunk_seeds",
+    "_process_pool",
+    "_chunk_perm_lmer",
+    "_r_package",
+    "_r_func",
+    "_shuffle_within",
+    "_data_fingerprint",
+    "_iter_frames",
     "_permute_sign",
+    "_OLSSolver",
     "_ols",
-    "_ols_group",
-    "_corr_group",
+    "_ols_groups",
+    "_ols_one_sample",
+    "_group_chunks",
+    "_corr_groups",
+    "_corrs_from_cov",
     "_perm_find",
     "_to_ranks_by_group",
+    "_formula_cols",
+    "_r_matrix",
+    "_r_table",
     "isPSD",
     "nearestPSD",
     "upper",
@@ -24,14 +41,144 @@ __author__ = ["Eshin Jolly"]
 __license__ = "MIT"
 
 import os 
+import re
+import hashlib
+import queue
+import threading
+from glob import glob
+from collections import deque
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
-from patsy import dmatrices
-from scipy.stats import chi2
+from scipy.stats import chi2, t as t_dist
+from scipy.linalg import solve_triangular
+from joblib import Parallel, effective_n_jobs
 from rpy2.robjects.packages import importr
+import rpy2.robjects as robjects
 
-base = importr("base")
 MAX_INT = np.iinfo(np.int32).max
+# Memory ceiling for the blocks of resampled responses (e.g. permuted dvs) held by all parallel workers at once
+MAX_CHUNK_BYTES = 2 ** 27
+# Numeric arrays larger than this are handed to worker processes as read-only memory maps instead of copies
+SHARED_MIN_BYTES = 2 ** 20
+
+# Source of the R helper functions used by models; all inputs are R parameters so each function only needs to be compiled once
+_R_SOURCES = {
+    "factorize": """
+        function(df, f, vals, lv, ordered){
+        df[,f] <- factor(vals, lv, ordered=ordered)
+        df
+        }
+    """,
+    "contrastize": """
+        function(df, f, c){
+        contrasts(df[,f]) <- c(c)
+        df
+        }
+    """,
+    "anova": """
+        function(model){
+        anova(model)
+        }
+    """,
+    "extract_lmer": """
+        function(model, conf_int, n_boot){
+        unsum <- unclass(summary(model))
+        blank <- function(x) ifelse(is.na(x), "", as.character(x))
+        tab <- function(x) list(as.matrix(x), as.character(rownames(x)), as.character(colnames(x)))
+        uniquify <- function(df){
+        colnames(df) <- make.unique(colnames(df))
+        df
+        }
+        coefs <- unsum$coefficients
+        if (nrow(coefs) > 0) {
+        ci <- confint(model, method=conf_int, nsim=n_boot)
+        coefs <- cbind(coefs, ci[rownames(coefs), , drop=FALSE])
+        }
+        vc <- as.data.frame(unsum$varcor)
+        list(
+        AIC=as.numeric(unsum$AICtab[1]),
+        logLike=as.numeric(unsum$logLik[1]),
+        messages=as.character(unlist(unsum$optinfo$conv$lme4$messages)),
+        warnings=as.character(unlist(unsum$optinfo$warnings)),
+        ngrps=as.numeric(unsum$ngrps),
+        ngrps_names=names(unsum$ngrps),
+        coefs=tab(coefs),
+        design_matrix=unname(model.matrix(model)),
+        varcor=list(grp=blank(vc$grp), var1=blank(vc$var1), var2=blank(vc$var2), vcov=as.numeric(vc$vcov), sdcor=as.numeric(vc$sdcor)),
+        fixef=lapply(coef(model), tab),
+        ranef=lapply(lapply(ranef(model), uniquify), tab),
+        residuals=as.numeric(resid(model)),
+        fits=as.numeric(fitted(model))
+        )
+        }
+    """,
+    "perm_setup": """
+        function(model, model_file){
+        if (is(model, "lmerModLmerTest")) model <- as(model, "lmerMod")
+        saveRDS(model, model_file, compress=FALSE)
+        grps <- interaction(lme4::getME(model, "flist"), drop=TRUE)
+        list(as.numeric(lme4::getME(model, "y")), as.integer(grps))
+        }
+    """,
+    "perm_lmer": """
+        function(model_file, perm_dvs){
+        model <- readRDS(model_file)
+        perm_dvs <- matrix(perm_dvs, nrow=length(lme4::getME(model, "y")))
+        out <- lapply(seq_len(ncol(perm_dvs)), function(i){
+        m <- lme4::refit(model, newresp=perm_dvs[, i])
+        lme4::fixef(m) / sqrt(diag(as.matrix(vcov(m))))
+        })
+        unlist(out)
+        }
+    """,
+    "simulate": """
+        function(model, nsim, use_rfx){
+        re_form <- if (use_rfx) NULL else NA
+        simulate(model, nsim, allow.new.levels=TRUE, re.form=re_form)
+        }
+    """,
+    "predict": """
+        function(model, new, use_rfx, pred_type){
+        re_form <- if (use_rfx) NULL else NA
+        predict(model, new, allow.new.levels=TRUE, re.form=re_form, type=pred_type)
+        }
+    """,
+    "emmeans": """
+        function(model, specs, adjust){
+        suppressMessages(library(emmeans))
+        emmeans(model, as.formula(specs), adjust=adjust)
+        }
+    """,
+    "emtrends": """
+        function(model, specs, var, adjust){
+        suppressMessages(library(emmeans))
+        # options need to be set explicitly for trends, see: https://bit.ly/2VJ9QZM
+        emtrends(model, as.formula(specs), var=var, adjust=adjust, options=list())
+        }
+    """,
+}
+
+# Compiled R functions and imported R packages, created on first use once per process (e.g. in each parallel worker) and reused across calls
+_R_FUNCS = {}
+_R_PACKAGES = {}
+
+
+def _r_func(name):
+    """Return the R helper function called name from _R_SOURCES, compiling it the first time it's requested."""
+
+    if name not in _R_FUNCS:
+        _R_FUNCS[name] = robjects.r(_R_SOURCES[name])
+    return _R_FUNCS[name]
+
+
+def _r_package(name):
+    """Return an rpy2 handle to an R package, importing it the first time it's requested."""
+
+    if name not in _R_PACKAGES:
+        _R_PACKAGES[name] = importr(name)
+    return _R_PACKAGES[name]
 
 
 def get_resource_path():
@@ -78,7 +225,9 @@ def _sig_stars(val):
     return star
 
 
-def _robust_estimator(vals, X, robust_estimator="hc1", n_lags=1, cluster=None):
+def _robust_estimator(
+    vals, X, robust_estimator="hc1", n_lags=1, cluster=None, solver=None
+):
     """
     Computes robust sandwich estimators for standard errors used in OLS computation. Types include:
     'hc0': Huber (1980) sandwich estimator to return robust standard error estimates.
@@ -89,14 +238,15 @@ def _robust_estimator(vals, X, robust_estimator="hc1", n_lags=1, cluster=None):
     Good reference: https://bit.ly/2VRb7jK
 
     Args:
-        vals (np.ndarray): 1d array of residuals
+        vals (np.ndarray): 1d array of residuals, or 2d array with one column of residuals per response fit to the same design matrix (e.g. permuted responses)
         X (np.ndarray): design matrix used in OLS
         robust_estimator (str): estimator type, 'hc0' (default), 'hc3', 'hac', or 'cluster'
-        n_lags (int): number of lags, only used with 'hac' estimator, default is 1
-        cluster (np.ndarry): array of cluster ids
+        n_lags (int/str): number of lags, only used with 'hac' estimator, default is 1. Use 'auto' to pick the number of lags based on the number of observations (see _hac_n_lags)
+        cluster (np.ndarry): integer cluster codes as returned by _cluster_codes; 2d codes request two-way clustering
+        solver (_OLSSolver): existing factorization of X to reuse; computed if not provided
 
     Returns:
-        stderr (np.ndarray): 1d array of standard errors with length == X.shape[1]
+        stderr (np.ndarray): 1d array of standard errors with length == X.shape[1]; 2d array (coefficients x responses) if vals is 2d
 
     """
 
@@ -110,8 +260,26 @@ def _robust_estimator(vals, X, robust_estimator="hc1", n_lags=1, cluster=None):
     ], "robust_estimator must be one of hc0, hc1, hc2, hc3, hac, or cluster"
 
     # Make a sandwich!
-    # First we need bread
-    bread = np.linalg.pinv(np.dot(X.T, X))
+    # First we need bread, which we can get from the factorization of X
+    if solver is None:
+        solver = _OLSSolver(X)
+    bread = solver.bread
+
+    if vals.ndim == 2 and robust_estimator in ["hac", "cluster"]:
+        # These don't vectorize over responses, so compute one response at a time
+        return np.column_stack(
+            [
+                _robust_estimator(
+                    vals[:, i],
+                    X,
+                    robust_estimator=robust_estimator,
+                    n_lags=n_lags,
+                    cluster=cluster,
+                    solver=solver,
+                )
+                for i in range(vals.shape[1])
+            ]
+        )
 
     # Then we need meat
     # First deal with estimators that have more complicated formulations
@@ -122,38 +290,42 @@ def _robust_estimator(vals, X, robust_estimator="hc1", n_lags=1, cluster=None):
         if cluster is None:
             raise ValueError("data column identifying clusters must be provided")
         else:
+            if isinstance(cluster, (pd.Series, pd.DataFrame)):
+                cluster = _cluster_codes(cluster)
             u = vals[:, np.newaxis] * X
-            u = pd.DataFrame(u)
-            # Use pandas groupby to get cluster-specific residuals
-            u["Group"] = cluster
-            u_clust = u.groupby("Group").sum()
-            num_grps = u["Group"].nunique()
-            meat = (
-                (num_grps / (num_grps - 1))
-                * (X.shape[0] / (X.shape[0] - X.shape[1]))
-                * u_clust.T.dot(u_clust)
-            )
+            if cluster.ndim == 1:
+                meat = _cluster_meat(u, cluster)
+            else:
+                # Two-way clustering (Cameron, Gelbach & Miller, 2011): add the meat for each clustering dimension and subtract the meat for their intersection
+                meat = (
+                    _cluster_meat(u, cluster[:, 0])
+                    + _cluster_meat(u, cluster[:, 1])
+                    - _cluster_meat(u, cluster[:, 2])
+                )
 
     # Auto-correlation robust
     elif robust_estimator == "hac":
+        if n_lags == "auto":
+            n_lags = _hac_n_lags(X.shape[0])
+        # Lags beyond the number of observations contribute nothing
+        n_lags = min(int(n_lags), X.shape[0] - 1)
         weights = 1 - np.arange(n_lags + 1.0) / (n_lags + 1.0)
 
+        # Scores for each observation; the meat only needs cross-products of these with lagged copies of themselves, so memory stays linear in n
+        u = vals[:, np.newaxis] * X
+
         # First compute lag 0
-        V = np.diag(vals ** 2)
-        meat = weights[0] * np.dot(np.dot(X.T, V), X)
+        meat = weights[0] * np.dot(u.T, u)
 
-        # Now loop over additional lags
+        # Now accumulate additional lags
         for l in range(1, n_lags + 1):
-
-            V = np.diag(vals[l:] * vals[:-l])
-            meat_1 = np.dot(np.dot(X[l:].T, V), X[:-l])
-            meat_2 = np.dot(np.dot(X[:-l].T, V), X[l:])
-
-            meat += weights[l] * (meat_1 + meat_2)
+            meat_l = np.dot(u[l:].T, u[:-l])
+            meat += weights[l] * (meat_l + meat_l.T)
 
     else:
         # Otherwise deal with estimators that modify the same essential operation
-        V = np.diag(vals ** 2)
+        # Only the diagonal of the weighting matrix is non-zero, so keep it as a vector of per-observation weights rather than a dense n x n matrix
+        V = vals ** 2
 
         if robust_estimator == "hc0":
             # No modification of residuals
@@ -165,19 +337,111 @@ def _robust_estimator(vals, X, robust_estimator="hc1", n_lags=1, cluster=None):
 
         elif robust_estimator == "hc2":
             # Rather than dof correction, weight residuals by reciprocal of "leverage values" in the hat-matrix
-            V = V / (1 - np.diag(np.dot(X, np.dot(bread, X.T))))
+            V = V / (1 - _as_column(solver.leverage, V))
 
         elif robust_estimator == "hc3":
             # Same as hc2 but more aggressive weighting due to squaring
-            V = V / (1 - np.diag(np.dot(X, np.dot(bread, X.T)))) ** 2
+            V = V / (1 - _as_column(solver.leverage, V)) ** 2
+
+        # Only the diagonal of the sandwich is needed: diag(bread X' diag(V) X bread) == (X bread)^2' V
+        # This is a single matrix product that also handles a 2d array of residuals from many responses at once
+        A = np.dot(X, bread)
+        return np.sqrt(np.dot((A ** 2).T, V))
 
-        meat = np.dot(np.dot(X.T, V), X)
     # Finally we make a sandwich
     vcv = np.dot(np.dot(bread, meat), bread)
 
     return np.sqrt(np.diag(vcv))
 
 
+def _as_column(arr, like):
+    """Add a trailing axis to a 1d array so it broadcasts against the rows of like if like is 2d."""
+    return arr[:, np.newaxis] if like.ndim == 2 else arr
+
+
+def _cluster_codes(clusters):
+    """
+    Convert cluster ids to integer codes so that cluster-robust standard errors can be computed with array reductions instead of pandas groupby operations. Intended to be computed once per model fit.
+
+    Args:
+        clusters (pd.Series/pd.DataFrame): cluster ids; a DataFrame with two columns requests two-way clustering
+
+    Returns:
+        np.ndarray: 1d array of codes for one-way clustering; for two-way clustering a 2d array whose columns are codes for the first dimension, the second dimension and their intersection
+    """
+
+    if isinstance(clusters, pd.DataFrame):
+        if clusters.shape[1] == 1:
+            clusters = clusters.iloc[:, 0]
+        elif clusters.shape[1] != 2:
+            raise ValueError("Only one-way or two-way clustering is supported")
+    if isinstance(clusters, pd.DataFrame):
+        first = pd.factorize(clusters.iloc[:, 0])[0]
+        second = pd.factorize(clusters.iloc[:, 1])[0]
+        both = pd.factorize(first * (second.max() + 1) + second)[0]
+        codes = np.column_stack([first, second, both])
+    else:
+        codes = pd.factorize(np.asarray(clusters))[0]
+    if np.any(codes < 0):
+        raise ValueError("cluster identifiers cannot contain missing values")
+    return codes
+
+
+def _cluster_dof(cluster, num_coefs):
+    """
+    Cluster corrected degrees of freedom (num clusters - num coefs). Differs from stata and statsmodels which use num clusters - 1. Ref: http://cameron.econ.ucdavis.edu/research/Cameron_Miller_JHR_2015_February.pdf. With two-way clustering the dimension with fewer clusters is used.
+
+    Args:
+        cluster (np.ndarray): integer cluster codes as returned by _cluster_codes
+        num_coefs (int): number of model coefficients
+
+    Returns:
+        int: degrees of freedom
+    """
+
+    if cluster.ndim == 1:
+        num_clusters = cluster.max() + 1
+    else:
+        num_clusters = min(cluster[:, 0].max(), cluster[:, 1].max()) + 1
+    return num_clusters - num_coefs
+
+
+def _cluster_meat(u, codes):
+    """
+    Meat of the cluster-robust sandwich estimator with small sample correction. Scores are summed within each cluster using bincount segment sums.
+
+    Args:
+        u (np.ndarray): 2d array of scores, i.e. residuals * design matrix
+        codes (np.ndarray): 1d array of integer cluster codes
+
+    Returns:
+        np.ndarray: 2d meat matrix
+    """
+
+    num_grps = codes.max() + 1
+    u_clust = np.column_stack(
+        [np.bincount(codes, weights=u[:, i], minlength=num_grps) for i in range(u.shape[1])]
+    )
+    return (
+        (num_grps / (num_grps - 1))
+        * (u.shape[0] / (u.shape[0] - u.shape[1]))
+        * np.dot(u_clust.T, u_clust)
+    )
+
+
+def _hac_n_lags(n_obs):
+    """
+    Automatic bandwidth (number of lags) for the Newey-West estimator using the Newey & West (1994) rule of thumb floor(4 * (n / 100) ^ (2 / 9)). This is the same default used by statsmodels.
+
+    Args:
+        n_obs (int): number of observations
+
+    Returns:
+        int: number of lags
+    """
+    return int(np.floor(4 * (n_obs / 100.0) ** (2.0 / 9.0)))
+
+
 def _whiten_wls(mat, weights):
     """
     Whiten a matrix for a WLS regression. Just multiply each column of mat by sqrt(weights) if mat is 2d. Similar to statsmodels
@@ -198,9 +462,84 @@ def _whiten_wls(mat, weights):
         return np.sqrt(weights)[:, None] * mat
 
 
-def _ols(x, y, robust, n_lags, cluster, all_stats=True, resid_only=False, weights=None):
+class _OLSSolver(object):
     """
-    Compute OLS on data. Useful for single computation and within permutation schemes.
+    Reusable factorization of a design matrix for OLS. X is factored once with a QR decomposition, or with an SVD if X is rank deficient (which gives the same minimum-norm solution as np.linalg.pinv), and the factorization is then reused to compute coefficients, standard errors, leverages and residuals for any number of responses without refactorizing.
+
+    Args:
+        X (np.ndarray): 2d design matrix
+        rcond (float): relative cutoff for small singular values when X is rank deficient; same as np.linalg.pinv
+
+    Attributes:
+        X (np.ndarray): design matrix
+        method (str): 'qr' or 'svd'
+        bread (np.ndarray): (pseudo-)inverse of X'X
+        leverage (np.ndarray): diagonal of the hat matrix
+    """
+
+    def __init__(self, X, rcond=1e-15):
+        self.X = X
+        self.n, self.p = X.shape
+        Q, R = np.linalg.qr(X)
+        r_diag = np.abs(np.diag(R))
+        tol = r_diag.max(initial=0) * max(X.shape) * np.finfo(X.dtype).eps
+        if self.p <= self.n and r_diag.size and r_diag.min() > tol:
+            self.method = "qr"
+            self._Q, self._R = Q, R
+            R_inv = solve_triangular(R, np.eye(self.p))
+            self.bread = np.dot(R_inv, R_inv.T)
+        else:
+            # Fall back to an SVD for rank deficient designs
+            self.method = "svd"
+            U, s, Vt = np.linalg.svd(X, full_matrices=False)
+            keep = s > rcond * s.max(initial=0)
+            self._U, self._s_inv, self._V = U[:, keep], 1.0 / s[keep], Vt[keep].T
+            self.bread = np.dot(self._V * self._s_inv ** 2, self._V.T)
+        self._leverage = None
+
+    def coef(self, Y):
+        """Coefficients for a 1d response or for each column of a 2d array of responses."""
+        if self.method == "qr":
+            return solve_triangular(self._R, np.dot(self._Q.T, Y))
+        Uy = np.dot(self._U.T, Y)
+        if Uy.ndim == 1:
+            return np.dot(self._V, self._s_inv * Uy)
+        return np.dot(self._V, self._s_inv[:, np.newaxis] * Uy)
+
+    def resid(self, Y, b=None):
+        """Residuals for the response(s) Y given their coefficients b, which are computed if not provided."""
+        if b is None:
+            b = self.coef(Y)
+        return Y - np.dot(self.X, b)
+
+    def se(self, res):
+        """Standard errors assuming homoscedastic errors from a 1d array of residuals or a 2d array with one column of residuals per response."""
+        sigma = np.sqrt(np.sum(res ** 2, axis=0) / (self.n - self.p))
+        if res.ndim == 1:
+            return np.sqrt(np.diag(self.bread)) * sigma
+        return np.sqrt(np.diag(self.bread))[:, np.newaxis] * sigma
+
+    @property
+    def leverage(self):
+        if self._leverage is None:
+            basis = self._Q if self.method == "qr" else self._U
+            self._leverage = np.sum(basis ** 2, axis=1)
+        return self._leverage
+
+
+def _ols(
+    x,
+    y,
+    robust,
+    n_lags,
+    cluster,
+    all_stats=True,
+    resid_only=False,
+    weights=None,
+    solver=None,
+):
+    """
+    Compute OLS on data. Useful for single computation and within permutation schemes. A pre-computed _OLSSolver for the (whitened) design matrix can be passed in to avoid refactorizing it.
     """
 
     if all_stats and resid_only:
@@ -215,113 +554,640 @@ def _ols(x, y, robust, n_lags, cluster, all_stats=True, resid_only=False, weight
         X = _whiten_wls(X, weights)
         Y = _whiten_wls(Y, weights)
 
+    if solver is None:
+        solver = _OLSSolver(X)
+
     # The good stuff
-    b = np.dot(np.linalg.pinv(X), Y)
+    b = solver.coef(Y)
 
     if all_stats:
 
-        res = Y - np.dot(X, b)
+        res = solver.resid(Y, b)
 
         if robust:
             se = _robust_estimator(
-                res, X, robust_estimator=robust, n_lags=n_lags, cluster=cluster
+                res,
+                solver.X,
+                robust_estimator=robust,
+                n_lags=n_lags,
+                cluster=cluster,
+                solver=solver,
             )
         else:
-            sigma = np.sqrt(res.T.dot(res) / (X.shape[0] - X.shape[1]))
-            se = np.sqrt(np.diag(np.linalg.pinv(np.dot(X.T, X)))) * sigma
+            se = solver.se(res)
 
         t = b / se
 
         return b, se, t, res
 
     elif resid_only:
-        return Y - np.dot(X, b)
+        return solver.resid(Y, b)
     else:
         return b
 
 
-def _chunk_perm_ols(x, y, robust, n_lags, cluster, weights, seed):
+def _chunk_perm_ols(solver, y, robust, n_lags, cluster, weights, seeds):
     """
-    Permuted OLS chunk.
+    Permuted OLS for a chunk of permutations. Rather than refitting the model once per permutation, the factorization of the design matrix is reused and the coefficients and t-statistics for every permuted response in the chunk are computed together as block matrix products.
+
+    Args:
+        solver (_OLSSolver): factorization of the (whitened) design matrix
+        y (np.ndarray): 1d array of the dependent variable, or 2d array with one column per dependent variable in which case all columns are shuffled together
+        robust (bool/str): robust estimator type or False
+        n_lags (int): number of lags for the 'hac' estimator
+        cluster (pd.Series/np.ndarray): cluster ids for the 'cluster' estimator
+        weights (np.ndarray): 1d array of WLS weights or None
+        seeds (np.ndarray): 1d array of seeds, one per permutation
+
+    Returns:
+        np.ndarray: 2d array of t-statistics (permutations x coefficients); 3d (permutations x coefficients x dependent variables) if y is 2d
     """
-    # Shuffle y labels
-    y = y.sample(frac=1, replace=False, random_state=seed)
-    b, s, t, res = _ols(x, y, robust, n_lags, cluster, weights=weights, all_stats=True)
 
-    return list(t)
+    # Each column (or block of columns if y is 2d) is a shuffled copy of y
+    Y = np.column_stack(
+        [y[np.random.RandomState(seed).permutation(y.shape[0])] for seed in seeds]
+    )
+    if weights is not None:
+        Y = _whiten_wls(Y, weights)
+
+    b = solver.coef(Y)
+    res = solver.resid(Y, b)
+
+    if robust:
+        se = _robust_estimator(
+            res,
+            solver.X,
+            robust_estimator=robust,
+            n_lags=n_lags,
+            cluster=cluster,
+            solver=solver,
+        )
+    else:
+        se = solver.se(res)
+
+    t = b / se
+    if y.ndim == 1:
+        return t.T
+    return t.reshape(t.shape[0], len(seeds), y.shape[1]).transpose(1, 0, 2)
+
 
+def _shuffle_within(y, codes, seed):
+    """
+    Shuffle an array within groups, so every value stays in its own group.
 
-def _permute_sign(data, seed, return_stat="mean"):
-    """Given a list/array of data, randomly sign flip the values and compute a new mean. For use in one-sample permutation test. Returns a 'mean' or 't-stat'."""
+    Args:
+        y (np.ndarray): 1d array to shuffle
+        codes (np.ndarray): 1d array of integer group codes, one per element of y
+        seed (int): random seed
+
+    Returns:
+        np.ndarray: shuffled copy of y
+    """
 
-    random_state = np.random.RandomState(seed)
-    new_dat = data * random_state.choice([1, -1], len(data))
-    if return_stat == "ceof":
-        return np.mean(new_dat)
-    elif return_stat == "t-stat":
-        return np.mean(new_dat) / (np.std(new_dat, ddof=1) / np.sqrt(len(new_dat)))
+    # Sorting on group codes and then random keys orders rows by group with a random order inside each group; writing them back into each group's original positions shuffles within groups
+    shuffled = np.lexsort((np.random.RandomState(seed).rand(y.shape[0]), codes))
+    out = np.empty_like(y)
+    out[np.argsort(codes, kind="stable")] = y[shuffled]
+    return out
 
 
-def _chunk_boot_ols_coefs(dat, formula, weights, seed):
+def _chunk_perm_lmer(model_file, y, codes, seeds):
     """
-    OLS computation of coefficients to be used in a parallelization context.
+    Refit a mixed model to a chunk of permuted responses. Rather than calling (g)lmer from scratch, the fitted model saved by the main process is loaded once per chunk and `lme4::refit` swaps in each permuted response, which reuses the parsed formula, random effects structure and model frame and starts optimization from the original variance component estimates. Responses are shuffled within groups in Python and sent to R as a single matrix, so all refits in a chunk run in a single R call. Meant to be scheduled on a pool of worker processes, each of which keeps its own R session with lme4 loaded across chunks.
+
+    Args:
+        model_file (str): path to the fitted lme4 model saved with saveRDS
+        y (np.ndarray): 1d array of the model's response, one per row of its model frame
+        codes (np.ndarray): 1d array of integer codes for the groups to permute within, one per element of y
+        seeds (np.ndarray): 1d array of seeds, one per permutation
+
+    Returns:
+        np.ndarray: 2d array of t or z statistics (permutations x coefficients)
     """
-    # Random sample with replacement from all data
-    dat = dat.sample(frac=1, replace=True, random_state=seed)
-    y, x = dmatrices(formula, dat, 1, return_type="dataframe")
-    b = _ols(
-        x, y, robust=None, n_lags=1, cluster=None, all_stats=False, weights=weights
+
+    perm_dvs = np.column_stack([_shuffle_within(y, codes, seed) for seed in seeds])
+    stats = _r_func("perm_lmer")(
+        model_file, robjects.FloatVector(perm_dvs.ravel(order="F"))
     )
-    return list(b)
-
-
-def _ols_group(dat, formula, group_col, group, rank):
-    """Compute OLS on data given a formula. Used by Lm2"""
-    dat = dat[dat[group_col] == group].reset_index(drop=True)
-    if rank:
-        dat = dat.rank()
-    y, x = dmatrices(formula, dat, 1, return_type="dataframe")
-    b = _ols(x, y, robust=None, n_lags=1, cluster=None, all_stats=False)
-    return list(b)
-
-
-def _corr_group(dat, formula, group_col, group, rank, corr_type):
-    """Compute partial correlations via OLS. Used by Lm2"""
-
-    from scipy.stats import pearsonr
-
-    dat = dat[dat[group_col] == group].reset_index(drop=True)
-    if rank:
-        dat = dat.rank()
-    y, x = dmatrices(formula, dat, 1, return_type="dataframe")
-    corrs = []
-    for c in x.columns[1:]:
-        other_preds = [e for e in x.columns if e != c]
-        other_preds = x[other_preds]
-        cc = x[c]
-        pred_m_resid = _ols(
-            other_preds,
-            cc,
-            robust=None,
-            n_lags=1,
-            cluster=None,
-            all_stats=False,
-            resid_only=True,
+    return np.array(stats, dtype=float).reshape(len(seeds), -1)
+
+
+def _process_pool(n_jobs=1):
+    """
+    Pool of worker processes for parallel resampling. Numeric arrays passed to tasks that are larger than SHARED_MIN_BYTES are written to disk once and opened by every worker as a read-only memory map rather than pickled into each task, so tasks should receive plain arrays (not dataframes) and must not modify them in place.
+
+    Args:
+        n_jobs (int): number of parallel workers
+
+    Returns:
+        joblib.Parallel: parallel pool
+    """
+
+    return Parallel(
+        n_jobs=n_jobs,
+        backend="multiprocessing",
+        max_nbytes=SHARED_MIN_BYTES,
+        mmap_mode="r",
+    )
+
+
+def _chunk_seeds(seeds, n_obs, n_jobs=1, max_bytes=MAX_CHUNK_BYTES):
+    """
+    Split an array of seeds into chunks for batched resampling. Chunks are sized so that the n_obs x chunk_size blocks of float64 values held by all parallel workers at once stay under max_bytes, and so that there are at least as many chunks as parallel workers.
+
+    Args:
+        seeds (np.ndarray): 1d array of seeds, one per resample
+        n_obs (int): number of observations in each resample
+        n_jobs (int): number of parallel workers; default 1
+        max_bytes (int): memory ceiling shared by the chunks being processed at the same time
+
+    Returns:
+        list: list of 1d arrays of seeds
+    """
+
+    n_workers = max(effective_n_jobs(n_jobs), 1)
+    chunk_size = min(
+        max_bytes // (8 * max(n_obs, 1) * n_workers),
+        int(np.ceil(len(seeds) / n_workers)),
+    )
+    chunk_size = max(chunk_size, 1)
+    return [seeds[i : i + chunk_size] for i in range(0, len(seeds), chunk_size)]
+
+
+def _read_frame(path):
+    """Read a single .csv or .parquet file into a dataframe."""
+
+    if path.lower().endswith((".parquet", ".pq")):
+        return pd.read_parquet(path)
+    return pd.read_csv(path)
+
+
+def _iter_frames(source, n_prefetch=0):
+    """
+    Iterate over dataframes from a streaming source so that only a few of them need to be in memory at once. Sources can be an iterable of dataframes (e.g. a generator reading from a partitioned store), a callable returning such an iterable, or the path to a directory whose .csv and .parquet files (searched recursively and in sorted order) are read one at a time. If n_prefetch > 0, up to that many frames are loaded ahead of the consumer in background threads so reading overlaps with computation; files in a directory are read concurrently, while other sources are advanced by a single background thread.
+
+    Args:
+        source (iterable/callable/str): source of dataframes
+        n_prefetch (int): number of frames to load ahead; default 0 (no prefetching)
+
+    Yields:
+        pd.DataFrame: the next frame
+    """
+
+    if isinstance(source, (str, os.PathLike)):
+        source = os.fspath(source)
+        if not os.path.isdir(source):
+            raise ValueError("{} is not a directory".format(source))
+        files = sorted(
+            path
+            for path in glob(os.path.join(source, "**", "*"), recursive=True)
+            if path.lower().endswith((".csv", ".parquet", ".pq"))
         )
-        if corr_type == "semi":
-            dv_m_resid = y.values.squeeze()
-        elif corr_type == "partial":
-            dv_m_resid = _ols(
-                other_preds,
-                y,
-                robust=None,
-                n_lags=1,
-                cluster=None,
-                all_stats=False,
-                resid_only=True,
+        if not files:
+            raise ValueError("No .csv or .parquet files found in {}".format(source))
+        loaders = [partial(_read_frame, path) for path in files]
+        if n_prefetch <= 0:
+            for load in loaders:
+                yield load()
+            return
+        with ThreadPoolExecutor(max_workers=n_prefetch) as executor:
+            pending = deque()
+            for load in loaders:
+                pending.append(executor.submit(load))
+                if len(pending) > n_prefetch:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        return
+
+    frames = source() if callable(source) else source
+    if n_prefetch <= 0:
+        yield from frames
+        return
+
+    # A bounded queue filled by a background thread; items are (done, frame or exception)
+    buffer = queue.Queue(maxsize=n_prefetch)
+    stop = threading.Event()
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce():
+        try:
+            for frame in frames:
+                if not _put((False, frame)):
+                    return
+        except Exception as e:
+            _put((True, e))
+            return
+        _put((True, None))
+
+    threading.Thread(target=_produce, daemon=True).start()
+    try:
+        while True:
+            done, item = buffer.get()
+            if done:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        # Let the producer exit if iteration stops early
+        stop.set()
+
+
+def _data_fingerprint(data, exclude_cols=None):
+    """
+    Compute a fingerprint of a dataframe's column names, index and values that can be used to check whether data have changed since a cached result was computed.
+
+    Args:
+        data (pd.DataFrame): data to fingerprint
+        exclude_cols (list): columns to ignore, e.g. columns that models write into their data after fitting; default None
+
+    Returns:
+        str: hex digest
+    """
+
+    if exclude_cols:
+        data = data.drop(columns=[c for c in exclude_cols if c in data.columns])
+    digest = hashlib.sha1(str(list(data.columns)).encode())
+    digest.update(pd.util.hash_pandas_object(data, index=True).values.tobytes())
+    return digest.hexdigest()
+
+
+def _permute_sign(
+    data,
+    n_perm,
+    return_stat="mean",
+    random_state=None,
+    weights=None,
+    max_bytes=MAX_CHUNK_BYTES,
+):
+    """
+    Sign-flip permutation null distribution for a one-sample test of every column of data at once. A single matrix of random sign flips (permutations x observations) is shared by all columns, so all columns are permuted with one matrix product and their permuted statistics come from the same permutations (e.g. for max-statistic corrections). If there are no more than n_perm possible sign patterns (2 ** number of observations), every pattern is enumerated instead for an exact test; the first pattern is then the unpermuted data. t-statistics reuse each column's sum of squares which sign flips don't change. With weights, permuted statistics are weighted means and WLS t-statistics. Non-finite observations are dropped from their own column only. Whether to enumerate is decided from the total number of observations: an enumeration is still exact for a column with dropped observations, since patterns that only differ on those observations repeat every pattern of the column's finite observations equally often, but a column with few enough finite observations to enumerate on its own falls back to random sign flips when all columns together have too many patterns.
+
+    Args:
+        data (np.ndarray): 1d array of observations or 2d array of observations x variables
+        n_perm (int): number of permutations
+        return_stat (str): 'mean' or 't-stat'; default 'mean'
+        random_state (int/np.random.RandomState): seed for drawing sign flips
+        weights (np.ndarray): WLS weights with the same shape as data; default None
+        max_bytes (int): memory ceiling for a single block of sign flips
+
+    Returns:
+        Multiple:
+
+            - **perm_stats** (*np.ndarray*): permuted statistics with one row per permutation (and one column per variable if data is 2d)
+
+            - **exact** (*bool*): whether all possible sign patterns were enumerated
+    """
+
+    if return_stat not in ["mean", "t-stat"]:
+        raise ValueError("return_stat must be 'mean' or 't-stat'")
+    n = data.shape[0]
+    n_obs = n
+    finite = np.isfinite(data)
+    if weights is not None:
+        finite &= np.isfinite(weights)
+    if not finite.all():
+        # Non-finite observations are left out of their column by giving them zero weight
+        weights = np.where(finite, 1.0 if weights is None else weights, 0.0)
+        data = np.where(finite, data, 0.0)
+        n_obs = finite.sum(axis=0)
+    exact = 2 ** n <= n_perm
+    if exact:
+        n_perm = 2 ** n
+    else:
+        random_state = _check_random_state(random_state)
+
+    chunk_size = max(1, max_bytes // (8 * n))
+    sums = []
+    for start in range(0, n_perm, chunk_size):
+        size = min(chunk_size, n_perm - start)
+        if exact:
+            # Bits of each pattern number give the signs for each observation
+            bits = (np.arange(start, start + size)[:, np.newaxis] >> np.arange(n)) & 1
+            flips = 1.0 - 2.0 * bits
+        else:
+            flips = random_state.choice([1.0, -1.0], size=(size, n))
+        sums.append(np.dot(flips, data if weights is None else weights * data))
+    if weights is None:
+        weights = np.ones_like(data)
+    w_sum = np.sum(weights, axis=0)
+    means = np.concatenate(sums) / w_sum
+
+    if return_stat == "mean":
+        return means, exact
+    ss = np.sum(weights * data ** 2, axis=0)
+    var = (ss - w_sum * means ** 2) / (n_obs - 1)
+    return means / np.sqrt(var / w_sum), exact
+
+
+def _chunk_boot_ols_coefs(x, y, weights, seeds):
+    """
+    OLS computation of bootstrapped coefficients for a chunk of resamples. The design matrix is only built once by the caller, so each resample just gathers rows by index and all resamples in the chunk are solved together as a stack.
+
+    Args:
+        x (np.ndarray): 2d design matrix
+        y (np.ndarray): 1d array of the dependent variable
+        weights (np.ndarray): 1d array of WLS weights or None
+        seeds (np.ndarray): 1d array of seeds, one per resample
+
+    Returns:
+        np.ndarray: 2d array of coefficients (resamples x coefficients)
+    """
+
+    n = x.shape[0]
+    # Random sample of row indices with replacement; one row of idx per resample
+    idx = np.array([np.random.RandomState(seed).randint(0, n, n) for seed in seeds])
+    X, Y = x[idx], y[idx]
+    if weights is not None:
+        w = np.sqrt(weights[idx])
+        X = X * w[:, :, np.newaxis]
+        Y = Y * w
+    b = np.matmul(np.linalg.pinv(X), Y[:, :, np.newaxis])
+    return b[:, :, 0]
+
+
+def _group_chunks(codes, row_bytes, max_bytes=MAX_CHUNK_BYTES):
+    """
+    Split the rows of a dataset into chunks of whole groups so that each chunk can be laid out as a zero-padded 3d array (groups x max group size x columns) without exceeding a memory ceiling. Groups are visited from smallest to largest so that groups in the same chunk have similar sizes and little memory is spent on padding.
+
+    Args:
+        codes (np.ndarray): 1d array of integer group codes from 0 to G - 1 for each row
+        row_bytes (int): number of bytes a single padded row will take up
+        max_bytes (int): memory ceiling shared by the chunks being processed at the same time
+
+    Yields:
+        tuple: group codes in the chunk, row indices into the data, position of each row's group in the chunk, and position of each row within its group
+    """
+
+    sizes = np.bincount(codes)
+    order = np.argsort(codes, kind="stable")
+    starts = np.cumsum(sizes) - sizes
+    by_size = np.argsort(sizes, kind="stable")
+
+    # Start a new chunk whenever adding the next (largest so far) group would exceed the ceiling
+    bounds = [0]
+    for i in range(1, len(by_size)):
+        if (i - bounds[-1] + 1) * sizes[by_size[i]] * row_bytes > max_bytes:
+            bounds.append(i)
+    bounds.append(len(by_size))
+
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        grps = by_size[start:end]
+        grp_sizes = sizes[grps]
+        local = np.repeat(np.arange(len(grps)), grp_sizes)
+        within = np.arange(grp_sizes.sum()) - np.repeat(
+            np.cumsum(grp_sizes) - grp_sizes, grp_sizes
+        )
+        rows = order[np.repeat(starts[grps], grp_sizes) + within]
+        yield grps, rows, local, within
+
+
+def _ols_groups(x, y, codes, max_bytes=MAX_CHUNK_BYTES):
+    """
+    Compute separate OLS coefficients for every group in the data using a single design matrix. Rows are arranged into zero-padded per-group blocks (padding rows do not change the solution) which are solved together with a batched pseudo-inverse. Used by Lm2
+
+    Args:
+        x (np.ndarray): 2d design matrix for all groups
+        y (np.ndarray): 1d array of dependent variable values
+        codes (np.ndarray): 1d array of integer group codes from 0 to G - 1 for each row
+        max_bytes (int): memory ceiling for the padded arrays of a single batch of groups
+
+    Returns:
+        np.ndarray: G x p array of coefficients
+    """
+
+    betas = np.empty((codes.max() + 1, x.shape[1]))
+    row_bytes = 8 * (x.shape[1] + 1)
+    for grps, rows, local, within in _group_chunks(codes, row_bytes, max_bytes):
+        x_pad = np.zeros((len(grps), within.max() + 1, x.shape[1]))
+        y_pad = np.zeros((len(grps), within.max() + 1))
+        x_pad[local, within] = x[rows]
+        y_pad[local, within] = y[rows]
+        betas[grps] = np.einsum("gpm,gm->gp", np.linalg.pinv(x_pad), y_pad)
+    return betas
+
+
+# Columns of the summary table returned by _ols_one_sample
+_ONE_SAMPLE_COLS = ["Estimate", "2.5_ci", "97.5_ci", "SE", "DF", "T-stat", "P-val", "Sig"]
+
+
+def _ols_one_sample(
+    data,
+    robust=False,
+    n_lags=1,
+    cluster=None,
+    conf_int="standard",
+    n_boot=500,
+    weights=None,
+):
+    """
+    One-sample inference (intercept-only OLS) on every column of data at once, e.g. the first-level coefficients of Lm2. Equivalent to fitting a separate intercept-only Lm to each column, but the design matrix is only factored once and standard errors, robust standard errors and bootstrapped confidence intervals are computed for all columns together. Bootstrap resamples are shared across columns. With weights, each column is instead estimated with WLS (e.g. precision weighting by first-level standard errors). Used by Lm2
+
+    Args:
+        data (np.ndarray): 2d array of observations x variables
+        robust (bool/str): robust estimator type to use as in _robust_estimator; default False
+        n_lags (int/str): number of lags for robust estimator type 'hac'
+        cluster (np.ndarray): integer cluster codes for each observation as returned by _cluster_codes; used with robust estimator type 'cluster'
+        conf_int (str): whether confidence intervals should be computed through bootstrap ('boot') or assuming a t-distribution ('standard'); default 'standard'
+        n_boot (int): how many bootstrap resamples to use for confidence intervals (ignored unless conf_int='boot')
+        weights (np.ndarray): 2d array of WLS weights with the same shape as data; default None
+
+    Returns:
+        pd.DataFrame: R style summary table with one row per column of data
+    """
+
+    finite = np.isfinite(data)
+    if weights is not None:
+        finite &= np.isfinite(weights)
+    if not finite.all():
+        # Like fitting each column separately, rows where a column isn't finite are dropped for that column; columns with the same rows are still estimated together
+        masks, inverse = np.unique(finite.T, axis=0, return_inverse=True)
+        results = []
+        for k, mask in enumerate(masks):
+            cols = np.flatnonzero(inverse.ravel() == k)
+            if mask.sum() < 2:
+                results.append(
+                    pd.DataFrame(np.nan, index=cols, columns=_ONE_SAMPLE_COLS).assign(Sig="")
+                )
+                continue
+            if cluster is None:
+                sub_cluster = None
+            elif cluster.ndim == 1:
+                sub_cluster = pd.factorize(cluster[mask])[0]
+            else:
+                sub_cluster = np.column_stack(
+                    [pd.factorize(c)[0] for c in cluster[mask].T]
+                )
+            result = _ols_one_sample(
+                data[mask][:, cols],
+                robust=robust,
+                n_lags=n_lags,
+                cluster=sub_cluster,
+                conf_int=conf_int,
+                n_boot=n_boot,
+                weights=None if weights is None else weights[mask][:, cols],
+            )
+            result.index = cols
+            results.append(result)
+        return pd.concat(results).sort_index()[_ONE_SAMPLE_COLS]
+
+    def _intercept_only(X, Y):
+        solver = _OLSSolver(X)
+        b = solver.coef(Y)
+        res = solver.resid(Y, b)
+        if robust:
+            se = _robust_estimator(
+                res,
+                X,
+                robust_estimator=robust,
+                n_lags=n_lags,
+                cluster=cluster,
+                solver=solver,
             )
-        corrs.append(pearsonr(dv_m_resid, pred_m_resid)[0])
-    return corrs
+        else:
+            se = solver.se(res)
+        return b[0], se[0]
+
+    if weights is None:
+        b, se = _intercept_only(np.ones((data.shape[0], 1)), data)
+    else:
+        # Each column has its own weights and so its own whitened design matrix
+        sqrt_w = np.sqrt(weights)
+        b, se = np.array(
+            [
+                _intercept_only(sqrt_w[:, [i]], data[:, i] * sqrt_w[:, i])
+                for i in range(data.shape[1])
+            ]
+        ).T
+    t = b / se
+
+    if robust == "cluster":
+        # Same cluster corrected dof as Lm
+        df = _cluster_dof(cluster, 1)
+    else:
+        df = data.shape[0] - 1
+    p = 2 * (1 - t_dist.cdf(np.abs(t), df))
+
+    if conf_int == "boot":
+        n = data.shape[0]
+        seeds = np.random.randint(MAX_INT, size=n_boot)
+        # Each resample of observations is shared by all columns
+        boot_means = []
+        for chunk in _chunk_seeds(seeds, data.size):
+            idx = np.array([np.random.RandomState(seed).randint(0, n, n) for seed in chunk])
+            if weights is None:
+                boot_means.append(data[idx].mean(axis=1))
+            else:
+                boot_w = weights[idx]
+                boot_means.append((boot_w * data[idx]).sum(axis=1) / boot_w.sum(axis=1))
+        boot_means = np.vstack(boot_means)
+        ci_u = np.percentile(boot_means, 97.5, axis=0)
+        ci_l = np.percentile(boot_means, 2.5, axis=0)
+    else:
+        ci_u = b + t_dist.ppf(0.975, df) * se
+        ci_l = b + t_dist.ppf(0.025, df) * se
+
+    return pd.DataFrame(
+        {
+            "Estimate": b,
+            "2.5_ci": ci_l,
+            "97.5_ci": ci_u,
+            "SE": se,
+            "DF": np.full(len(b), df, dtype=float),
+            "T-stat": t,
+            "P-val": p,
+            "Sig": [_sig_stars(elem) for elem in p],
+        },
+        columns=_ONE_SAMPLE_COLS,
+    )
+
+
+def _corrs_from_cov(cov, corr_type):
+    """
+    Compute the partial or semi-partial correlation between a dependent variable and every predictor at once from the covariance matrix of [predictors, dv] (the dv must be the last row/column). Only the predictor block is inverted, so a dv that is an exact linear function of the predictors is handled correctly: regression coefficients come from B = Sxx^-1 Sxy, semi-partial correlations rescale each coefficient by the residual variance of its predictor, 1 / (Sxx^-1)_jj, and the variance of the dv, and partial correlations follow from semi-partials and the model R^2 as sr_j / sqrt(1 - R^2 + sr_j^2). This is equivalent to residualizing each predictor (and the dv for partial correlations) on all other predictors and an intercept and correlating the residuals. Works on a stack of covariance matrices, e.g. one per group, with shape (..., k+1, k+1).
+
+    Args:
+        cov (np.ndarray): covariance matrix (or stack of matrices) of the predictors and dv, with the dv last
+        corr_type (string): 'semi' or 'partial'
+
+    Returns:
+        np.ndarray: correlations with shape (..., k)
+    """
+
+    if corr_type not in ["semi", "partial"]:
+        raise ValueError("corr_type must be 'semi' or 'partial'")
+    s_xx_inv = np.linalg.pinv(cov[..., :-1, :-1])
+    s_xy = cov[..., :-1, -1]
+    s_yy = cov[..., -1:, -1]
+    b = np.einsum("...ij,...j->...i", s_xx_inv, s_xy)
+    semi = b / np.sqrt(np.diagonal(s_xx_inv, axis1=-2, axis2=-1) * s_yy)
+    if corr_type == "semi":
+        return semi
+    r2 = np.einsum("...i,...i->...", s_xy, b)[..., np.newaxis] / s_yy
+    # Proportion of dv variance left unexplained by every predictor but one; when the fit is perfect and a predictor adds nothing this is 0 (up to rounding) and so is its partial correlation
+    unexplained = 1 - r2 + semi ** 2
+    unexplained = np.where(unexplained <= 1e-12, 0.0, unexplained)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(unexplained == 0, 0.0, semi / np.sqrt(unexplained))
+
+
+def _corr_groups(x, y, codes, corr_type, max_bytes=MAX_CHUNK_BYTES):
+    """
+    Compute semi-partial or partial correlations between a dv and each predictor separately for every group in the data using a single design matrix. Each group's covariance matrix of [predictors, dv] is computed from group-centered rows laid out in zero-padded per-group blocks, and all groups' correlations are then derived together from the stack of covariance matrices. The first column of x is assumed to be the intercept and is excluded. Used by Lm2
+
+    Args:
+        x (np.ndarray): 2d design matrix for all groups
+        y (np.ndarray): 1d array of dependent variable values
+        codes (np.ndarray): 1d array of integer group codes from 0 to G - 1 for each row
+        corr_type (string): 'semi' or 'partial'
+        max_bytes (int): memory ceiling for the padded arrays of a single batch of groups
+
+    Returns:
+        np.ndarray: G x (p - 1) array of correlations
+    """
+
+    z = np.column_stack([x[:, 1:], y])
+    sizes = np.bincount(codes)
+    means = np.column_stack(
+        [np.bincount(codes, weights=z[:, i]) for i in range(z.shape[1])]
+    ) / sizes[:, np.newaxis]
+    z = z - means[codes]
+    covs = np.empty((len(sizes), z.shape[1], z.shape[1]))
+    for grps, rows, local, within in _group_chunks(codes, 8 * z.shape[1], max_bytes):
+        z_pad = np.zeros((len(grps), within.max() + 1, z.shape[1]))
+        z_pad[local, within] = z[rows]
+        covs[grps] = np.einsum("gmi,gmj->gij", z_pad, z_pad)
+    covs /= (sizes - 1)[:, np.newaxis, np.newaxis]
+    return _corrs_from_cov(covs, corr_type)
+
+
+def _formula_cols(formula, columns):
+    """
+    Find the columns of a dataframe that a model formula refers to, so only those need to be converted or copied.
+
+    Args:
+        formula (str): model formula
+        columns (list): candidate column names, e.g. data.columns
+
+    Returns:
+        list: columns in their original order that appear as whole names in the formula
+    """
+
+    formula = formula.replace(" ", "")
+    return [
+        c
+        for c in columns
+        if re.search(r"(?<![\w.])" + re.escape(str(c)) + r"(?![\w.])", formula)
+    ]
 
 
 def _to_ranks_by_group(dat, group, formula, exclude_cols=[]):
@@ -442,13 +1308,6 @@ def upper(mat):
     return mat[idx]
 
 
-def _return_t(model):
-    """Return t or z stat from R model summary."""
-    summary = base.summary(model)
-    unsum = base.unclass(summary)
-    return unsum.rx2("coefficients")[:, -1]
-
-
 def _get_params(model):
     """Get number of params in a model."""
     return model.coefs.shape[0]
@@ -504,6 +1363,19 @@ def R2con(arr):
     return inv
 
 
+def _r_matrix(mat):
+    """Convert an R numeric matrix to a 2d numpy array without going through pandas."""
+
+    return np.array(mat, dtype=float).reshape(tuple(mat.dim), order="F")
+
+
+def _r_table(table):
+    """Build a dataframe from an R list of a numeric matrix and its row and column names."""
+
+    values, rows, cols = table
+    return pd.DataFrame(_r_matrix(values), index=list(rows), columns=list(cols))
+
+
 def _df_meta_to_arr(df):
     """Check what kind of data exists in pandas columns or index. If string return as numpy array 'S' type, otherwise regular numpy array.
     """